@@ -0,0 +1,145 @@
+"""
+Micro-benchmarks for resource loader hot paths, using synthetic data.
+"""
+
+from ..utils import game_parse
+from ..utils import pk3_data
+from ..utils import pk3_checksum
+from ..utils import dependency_resolver
+from ..utils import misc
+from . import synthetic
+import random
+import statistics
+import tempfile
+import os
+import timeit
+import typing
+
+# Benchmark name => setup function, which returns the function to be timed.
+benchmarks : dict[str, typing.Callable[[random.Random], typing.Callable]] = {}
+
+def benchmark(name:str):
+  def register(setup):
+    benchmarks[name] = setup
+    return setup
+  return register
+
+@benchmark("GameTextParse")
+def setup_game_text_parse(rng:random.Random):
+  text = synthetic.make_shader_script(rng, 0, 200)
+  def run():
+    parser = game_parse.GameTextParse(text)
+    while not parser.completed():
+      parser.ParseExt(True)
+  return run
+
+@benchmark("ExtractShaders")
+def setup_extract_shaders(rng:random.Random):
+  text = synthetic.make_shader_script(rng, 0, 200)
+  return lambda: game_parse.ExtractShaders(text)
+
+@benchmark("ShaderDependencies")
+def setup_shader_dependencies(rng:random.Random):
+  shaders = [shader.text for shader in game_parse.ExtractShaders(synthetic.make_shader_script(rng, 0, 200, 4)).shaders]
+  def run():
+    for text in shaders:
+      game_parse.ShaderDependencies(text)
+  return run
+
+@benchmark("Entities.import_text")
+def setup_entities_import(rng:random.Random):
+  text = synthetic.make_entity_lump(rng, 1000)
+  return lambda: game_parse.Entities().import_text(text)
+
+@benchmark("Entities.export_text")
+def setup_entities_export(rng:random.Random):
+  entities = synthetic.make_entities(rng, 1000)
+  return entities.export_text
+
+@benchmark("BspData")
+def setup_bsp_data(rng:random.Random):
+  shaders = [synthetic.shader_name(index) for index in range(500)]
+  data = synthetic.make_bsp(rng, shaders, 20000, 500)
+  return lambda: pk3_data.BspData(data).get_info()
+
+@benchmark("Md3Data")
+def setup_md3_data(rng:random.Random):
+  data = synthetic.make_md3(rng, 50, 4)
+  return lambda: pk3_data.Md3Data(data).GetInfo()
+
+@benchmark("strip_server_bsp")
+def setup_strip_server_bsp(rng:random.Random):
+  shaders = [synthetic.shader_name(index) for index in range(500)]
+  data = synthetic.make_bsp(rng, shaders, 20000, 500, padding=4000000)
+  return lambda: misc.strip_server_bsp(data)
+
+@benchmark("get_pk3_hash")
+def setup_get_pk3_hash(rng:random.Random):
+  crcs = [rng.getrandbits(32) for _ in range(5000)]
+  return lambda: pk3_data.get_pk3_hash(crcs)
+
+@benchmark("crc_list_hashes")
+def setup_crc_list_hashes(rng:random.Random):
+  crc_lists = [[rng.getrandbits(32) for _ in range(rng.randrange(10, 500))] for _ in range(100)]
+  return lambda: pk3_checksum.crc_list_hashes(crc_lists)
+
+def make_dependency_setup(rng:random.Random):
+  """ Returns asset index with overlapping synthetic pk3s, a source list, and bsp info. """
+  index = dependency_resolver.AssetIndex()
+  source_list = dependency_resolver.SourceList(index)
+  with tempfile.TemporaryDirectory() as temp_dir:
+    for pk3_num in range(10):
+      path = os.path.join(temp_dir, "pak%i.pk3" % pk3_num)
+      with open(path, "wb") as tgt:
+        tgt.write(synthetic.make_pk3(rng, ["map%i" % pk3_num] if pk3_num == 0 else [], pk3_num * 80, 100,
+                                     pk3_num * 150, 200, range(1000), range(1600), map_shader_count=300))
+      info = pk3_data.get_pk3_info(path)
+      source = "baseEF/pak%i" % pk3_num
+      index.register_pk3(source, info)
+      source_list.add_source(source, pk3_num % 3)
+      if pk3_num == 0:
+        bsp_info = info["pk3_subfiles"][0]["bspinfo"]
+  pool = dependency_resolver.DependencyPool()
+  pool.add_bsp_dependencies(bsp_info)
+  return pool, source_list
+
+@benchmark("resolve_dependencies")
+def setup_resolve_dependencies(rng:random.Random):
+  pool, source_list = make_dependency_setup(rng)
+  return lambda: dependency_resolver.resolve_dependencies(pool, source_list)
+
+@benchmark("get_minimum_sources")
+def setup_get_minimum_sources(rng:random.Random):
+  pool, source_list = make_dependency_setup(rng)
+  res = dependency_resolver.resolve_dependencies(pool, source_list)
+  return lambda: dependency_resolver.get_minimum_sources(res, source_list)
+
+def run_benchmark(setup:typing.Callable[[random.Random], typing.Callable], repeat:int=5, seed:int=0) -> dict:
+  """ Times benchmark, returning best and median seconds per call. """
+  func = setup(random.Random(seed))
+  timer = timeit.Timer(func)
+  loops, _ = timer.autorange()
+  times = [total / loops for total in timer.repeat(repeat, loops)]
+  return {"best": min(times), "median": statistics.median(times), "loops": loops}
+
+def run_benchmarks(names:list[str]|None=None, repeat:int=5) -> dict[str, dict]:
+  results : dict[str, dict] = {}
+  for name, setup in benchmarks.items():
+    if names and name not in names:
+      continue
+    results[name] = run_benchmark(setup, repeat)
+    print("%s: %.3f ms" % (name, results[name]["best"] * 1000))
+  return results
+
+def compare_results(results:dict[str, dict], baseline:dict[str, dict], threshold:float) -> list[str]:
+  """ Returns list of benchmarks whose best time exceeds the baseline by more than threshold
+  (e.g. 0.1 for 10%), formatted as readable strings. """
+  regressions : list[str] = []
+  for name, result in results.items():
+    if name not in baseline:
+      continue
+    ratio = result["best"] / baseline[name]["best"]
+    if ratio > 1 + threshold:
+      regressions.append("%s: %.3f ms vs baseline %.3f ms (+%.1f%%)" % (name, result["best"] * 1000,
+                         baseline[name]["best"] * 1000, (ratio - 1) * 100))
+  return regressions
@@ -0,0 +1,204 @@
+"""
+End-to-end export scaling benchmark. Generates a synthetic manifest with a configurable
+number of pk3s, serves the pk3s from a local http server standing in for the manifest
+resource urls, and runs the real export cold (empty cache) and warm (cache populated by
+the cold run), recording per-phase metrics and peak RSS for each size.
+"""
+
+from ..export import export
+from ..utils import misc
+from ..utils import profiling
+from . import synthetic
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import threading
+import time
+import zipfile
+
+# Shader and texture indices for the common pk3 are placed above the range used by map pk3s
+common_index_start = 10000000
+common_pak_name = "baseEF/synthcommon"
+
+class PakSetConfig():
+  """ Parameters for generated pk3s. Overlap is the fraction of each pk3's shader and texture
+  range that is also defined by the next pk3. Maps and shaders in each pk3 reference its own
+  range plus the common pk3, which is available to all maps through the profile. """
+  def __init__(self, maps_per_pk3:int=2, shaders_per_pk3:int=100, textures_per_pk3:int=50,
+               overlap:float=0.25, seed:int=0):
+    self.maps_per_pk3 = maps_per_pk3
+    self.shaders_per_pk3 = shaders_per_pk3
+    self.textures_per_pk3 = textures_per_pk3
+    self.overlap = overlap
+    self.seed = seed
+
+  def get_key(self) -> str:
+    return "m%i_s%i_t%i_o%g_r%i" % (self.maps_per_pk3, self.shaders_per_pk3, self.textures_per_pk3,
+                                   self.overlap, self.seed)
+
+  def get_stride(self, count:int) -> int:
+    return max(1, round(count * (1 - self.overlap)))
+
+class PakSet():
+  """ Writes generated pk3s to resource_dir, named by sha256 hash. Each pk3 is generated from
+  its own seed so larger sets reuse the pk3s of smaller ones, and generated hashes are saved
+  so pk3s are only built once per configuration. """
+  def __init__(self, resource_dir:str, config:PakSetConfig):
+    self.resource_dir = resource_dir
+    self.config = config
+    self.index_path = os.path.join(resource_dir, "paks_%s.json" % config.get_key())
+    self.hashes : dict[str, str] = {}   # pak name => sha256
+    if os.path.exists(self.index_path):
+      self.hashes = misc.read_json_file(self.index_path)
+
+  def write_pk3(self, data:bytes) -> str:
+    res_hash = hashlib.sha256(data).hexdigest()
+    path = os.path.join(self.resource_dir, res_hash)
+    if not os.path.exists(path):
+      with open(path, "wb") as tgt:
+        tgt.write(data)
+    return res_hash
+
+  def get_pak_name(self, pk3_num:int) -> str:
+    return "baseEF/synth%05i" % pk3_num
+
+  def make_common_pk3(self) -> bytes:
+    config = self.config
+    rng = random.Random("%i-common" % config.seed)
+    textures = range(common_index_start, common_index_start + config.textures_per_pk3)
+    return synthetic.make_pk3(rng, [], common_index_start, config.shaders_per_pk3, common_index_start,
+                              config.textures_per_pk3, [], textures)
+
+  def make_map_pk3(self, pk3_num:int) -> bytes:
+    config = self.config
+    rng = random.Random("%i-%i" % (config.seed, pk3_num))
+    shader_start = pk3_num * config.get_stride(config.shaders_per_pk3)
+    texture_start = pk3_num * config.get_stride(config.textures_per_pk3)
+    shader_pool = [*range(shader_start, shader_start + config.shaders_per_pk3),
+                   *range(common_index_start, common_index_start + config.shaders_per_pk3)]
+    texture_pool = [*range(texture_start, texture_start + config.textures_per_pk3),
+                    *range(common_index_start, common_index_start + config.textures_per_pk3)]
+    map_names = ["synth%05i_%i" % (pk3_num, map_num) for map_num in range(config.maps_per_pk3)]
+    return synthetic.make_pk3(rng, map_names, shader_start, config.shaders_per_pk3, texture_start,
+                              config.textures_per_pk3, shader_pool, texture_pool)
+
+  def get_hashes(self, pk3_count:int) -> dict[str, str]:
+    """ Returns pak name => sha256 for the common pk3 and pk3_count map pk3s, generating
+    any that don't exist yet. """
+    os.makedirs(self.resource_dir, exist_ok=True)
+    updated = False
+    if not common_pak_name in self.hashes:
+      self.hashes[common_pak_name] = self.write_pk3(self.make_common_pk3())
+      updated = True
+    for pk3_num in range(pk3_count):
+      pak_name = self.get_pak_name(pk3_num)
+      if not pak_name in self.hashes:
+        self.hashes[pak_name] = self.write_pk3(self.make_map_pk3(pk3_num))
+        updated = True
+    if updated:
+      misc.write_json_file(self.hashes, self.index_path)
+    return {name: self.hashes[name] for name in [common_pak_name, *map(self.get_pak_name, range(pk3_count))]}
+
+def make_manifest(pak_hashes:dict[str, str], resource_url:str) -> dict:
+  """ Returns manifest data with all map pk3s using a profile that includes the common pk3. """
+  paks = {name: {"sha256": res_hash, "profile": "synthetic"} for name, res_hash in pak_hashes.items()}
+  paks[common_pak_name] = {"sha256": pak_hashes[common_pak_name]}
+  return {
+    "resource_urls": [resource_url],
+    "profiles": {
+      "synthetic": {
+        "client_paks": {
+          "*map_pak": {"dep_group": 300, "download": "yes", "priority": 300.999, "pure": "yes"},
+          common_pak_name: {"dep_group": 500, "download": "no", "priority": 500.999, "pure": "yes"},
+        },
+      },
+    },
+    "paks": paks,
+  }
+
+class QuietRequestHandler(http.server.SimpleHTTPRequestHandler):
+  def log_message(self, format, *args):
+    pass
+
+class ResourceServer():
+  """ Serves files in directory over http on a local port from a background thread. """
+  def __init__(self, directory:str):
+    handler = functools.partial(QuietRequestHandler, directory=directory)
+    self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+  def get_resource_url(self) -> str:
+    """ Returns url in manifest resource_urls format. """
+    return "http://127.0.0.1:%i/{hash}" % self.server.server_address[1]
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+def run_export_process(manifest_data:dict, output_path:str, log_path:str) -> dict:
+  """ Runs export and returns wall time, peak RSS, and phase metrics. Intended to run in a
+  fresh process so peak RSS reflects only this export. """
+  manifest = export.Manifest()
+  manifest.import_manifest(manifest_data)
+  with open(log_path, "w", encoding="utf-8") as log, contextlib.redirect_stdout(log):
+    start = time.perf_counter()
+    export.run_export(manifest, output_path)
+    wall = time.perf_counter() - start
+  with zipfile.ZipFile(os.path.join(output_path, "data", "logs.zip")) as logs:
+    phases = json.loads(logs.read("metrics.json"))["phases"]
+  return {"wall": round(wall, 6), "peak_rss": profiling.get_peak_rss(), "phases": phases}
+
+def run_in_new_process(func, *args):
+  # Use spawn so the worker doesn't inherit memory from this process
+  with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+    return executor.submit(func, *args).result()
+
+def run_scaling(work_dir:str, pk3_counts:list[int], config:PakSetConfig, keep_output:bool=False) -> list[dict]:
+  """ Runs cold and warm export for each pk3 count and returns results. """
+  pak_set = PakSet(os.path.join(work_dir, "resources"), config)
+  results : list[dict] = []
+  with ResourceServer(pak_set.resource_dir) as server:
+    for pk3_count in pk3_counts:
+      print("Generating %i pk3s..." % pk3_count)
+      manifest_data = make_manifest(pak_set.get_hashes(pk3_count), server.get_resource_url())
+      output_path = os.path.join(work_dir, "export_%i" % pk3_count)
+      if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+      result = {"pk3_count": pk3_count, "map_count": pk3_count * config.maps_per_pk3}
+      for run in ("cold", "warm"):
+        print("Running %s export..." % run)
+        result[run] = run_in_new_process(run_export_process, manifest_data, output_path,
+                                         os.path.join(work_dir, "export_%i_%s.txt" % (pk3_count, run)))
+      results.append(result)
+      print('\n'.join(get_summary(results[-1:], header=False)))
+      if not keep_output:
+        shutil.rmtree(output_path)
+  return results
+
+summary_phases = ("pk3_load", "asset_index", "load_map", "mirror_linking", "directory_cycling")
+
+def get_summary(results:list[dict], header:bool=True) -> list[str]:
+  """ Returns table lines with wall time, peak RSS and main phase times per run. """
+  lines : list[str] = []
+  if header:
+    lines.append("%8s %8s %5s %9s %9s " % ("pk3s", "maps", "run", "wall", "rss_mb") +
+                 " ".join("%14s" % phase for phase in summary_phases))
+  for result in results:
+    for run in ("cold", "warm"):
+      stats = result[run]
+      rss = "%9.1f" % (stats["peak_rss"] / 1024**2) if stats["peak_rss"] != None else "%9s" % "-"
+      lines.append("%8i %8i %5s %9.2f %s " % (result["pk3_count"], result["map_count"], run, stats["wall"], rss) +
+                   " ".join("%14.2f" % stats["phases"].get(phase, {}).get("wall", 0) for phase in summary_phases))
+  return lines
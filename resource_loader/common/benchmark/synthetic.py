@@ -0,0 +1,130 @@
+"""
+Generates deterministic synthetic game data (bsp, md3, shader scripts, entities, pk3s)
+for benchmarking. The same seed and parameters always produce identical output.
+"""
+
+from ..utils import game_parse
+import io
+import random
+import struct
+import typing
+import zipfile
+
+def shader_name(index:int) -> str:
+  return "textures/synthetic/shader%05i" % index
+
+def texture_name(index:int) -> str:
+  return "textures/synthetic/image%05i" % index
+
+def make_entities(rng:random.Random, entity_count:int) -> game_parse.Entities:
+  classnames = ("info_player_deathmatch", "weapon_compressionrifle", "item_hypo", "light",
+                "target_speaker", "misc_model_breakable", "func_door", "target_location")
+  entities = game_parse.Entities()
+  worldspawn = game_parse.Entity()
+  worldspawn.set("classname", "worldspawn")
+  worldspawn.set("music", "music/synthetic_start.mp3 music/synthetic_loop.mp3")
+  entities.entities.append(worldspawn)
+  for index in range(entity_count):
+    entity = game_parse.Entity()
+    classname = rng.choice(classnames)
+    entity.set("classname", classname)
+    entity.set("origin", "%i %i %i" % (rng.randint(-4096, 4096), rng.randint(-4096, 4096), rng.randint(-512, 512)))
+    entity.set("angle", str(rng.randint(0, 359)))
+    if classname == "target_speaker":
+      entity.set("noise", "sound/synthetic/noise%03i.wav" % rng.randint(0, 99))
+    if classname == "misc_model_breakable":
+      entity.set("model", "models/synthetic/model%03i.md3" % rng.randint(0, 99))
+      entity.set("health", str(rng.choice((0, 50))))
+    if classname == "target_location":
+      entity.set("message", "location %i" % index)
+    entities.entities.append(entity)
+  return entities
+
+def make_entity_lump(rng:random.Random, entity_count:int) -> bytes:
+  return make_entities(rng, entity_count).export_text()
+
+def make_bsp(rng:random.Random, shaders:list[str], surface_count:int, entity_count:int=100,
+             fog_count:int=2, padding:int=0) -> bytes:
+  """ Returns bsp data with the given shaders and number of surfaces and entities. Padding adds
+  filler to lumps stripped by misc.strip_server_bsp. """
+  lumps = [b''] * 17
+  lumps[0] = make_entity_lump(rng, entity_count)
+  lumps[1] = b''.join(shader.encode('ascii').ljust(64, b'\0') + struct.pack("<ii", 0, 0) for shader in shaders)
+  lumps[12] = b''.join(rng.choice(shaders).encode('ascii').ljust(64, b'\0') + struct.pack("<ii", 0, 0)
+                       for _ in range(fog_count))
+  lumps[13] = b''.join(struct.pack("<ii", rng.randrange(len(shaders)), -1) + bytes(96)
+                       for _ in range(surface_count))
+  for lumpnum in (11, 14, 15):
+    lumps[lumpnum] = bytes(padding)
+
+  header = b'IBSP' + struct.pack("<i", 46)
+  data = b''
+  offset = 8 + 17 * 8
+  for lump in lumps:
+    header += struct.pack("<ii", offset + len(data), len(lump))
+    data += lump
+  return header + data
+
+def make_md3(rng:random.Random, surface_count:int, shaders_per_surface:int=1, shader_count:int=1000) -> bytes:
+  """ Returns md3 data containing surface headers and shader references only. """
+  surfaces = b''
+  for surface_index in range(surface_count):
+    shaders = b''.join(shader_name(rng.randrange(shader_count)).encode('ascii').ljust(64, b'\0') +
+                       struct.pack("<i", 0) for _ in range(shaders_per_surface))
+    surface_length = 108 + len(shaders)
+    surfaces += b'IDP3' + ("surface%i" % surface_index).encode('ascii').ljust(64, b'\0') + \
+      struct.pack("<iiiiiiiiii", 0, 1, shaders_per_surface, 0, 0, 0, 108, 0, 0, surface_length) + shaders
+
+  header = b'IDP3' + struct.pack("<i", 15) + b'synthetic'.ljust(64, b'\0') + \
+    struct.pack("<iiiiiiiii", 0, 1, 0, surface_count, 0, 108, 108, 108, 108 + len(surfaces))
+  return header + surfaces
+
+def make_shader(rng:random.Random, name:str, stage_count:int, textures:typing.Sequence[int]) -> str:
+  """ Returns shader text with stages referencing textures selected from the given indices. """
+  lines = [name, "{", "\tsurfaceparm nomarks", "\tqer_editorimage %s.tga" % texture_name(rng.choice(textures))]
+  if rng.random() < 0.1:
+    lines.append("\tskyParms env/synthetic%03i 512 -" % rng.randrange(100))
+  if rng.random() < 0.2:
+    lines.append("\tdeformVertexes wave 100 sin 0 3 0 0.5")
+  for _ in range(stage_count):
+    lines.append("\t{")
+    if rng.random() < 0.2:
+      lines.append("\t\tanimMap 8 " +  " ".join("%s.tga" % texture_name(rng.choice(textures)) for _ in range(4)))
+    else:
+      lines.append("\t\tmap %s.tga" % texture_name(rng.choice(textures)))
+    lines.append("\t\tblendFunc GL_ONE GL_ONE")
+    lines.append("\t\trgbGen wave sin 0.5 0.5 0 1")
+    lines.append("\t\ttcMod scroll 0.1 0.2 // synthetic comment")
+    lines.append("\t}")
+  lines.append("}")
+  return "\n".join(lines)
+
+def make_shader_script(rng:random.Random, first_shader:int, shader_count:int, stage_count:int=2,
+                       textures:typing.Sequence[int]=range(1000)) -> str:
+  return "\n\n".join(make_shader(rng, shader_name(first_shader + index), stage_count, textures)
+                     for index in range(shader_count)) + "\n"
+
+def write_pk3_file(pk3:zipfile.ZipFile, name:str, data:bytes|str):
+  # Use fixed timestamp so output is deterministic
+  info = zipfile.ZipInfo(name, date_time=(2000, 1, 1, 0, 0, 0))
+  info.compress_type = zipfile.ZIP_DEFLATED
+  pk3.writestr(info, data)
+
+def make_pk3(rng:random.Random, map_names:list[str], shader_start:int, shader_count:int, texture_start:int,
+             texture_count:int, shader_pool:typing.Sequence[int], texture_pool:typing.Sequence[int],
+             map_shader_count:int=50, surface_count:int=500, entity_count:int=100) -> bytes:
+  """ Returns pk3 data containing the given maps, a shader script defining shaders in
+  [shader_start, shader_start+shader_count), and textures in [texture_start, texture_start+texture_count).
+  Maps reference shaders selected from shader_pool and shader stages reference textures selected
+  from texture_pool, so overlap between pk3s is controlled by how the ranges and pools intersect. """
+  output = io.BytesIO()
+  with zipfile.ZipFile(output, 'w') as pk3:
+    for map_name in map_names:
+      shaders = [shader_name(index) for index in rng.sample(shader_pool, min(map_shader_count, len(shader_pool)))]
+      write_pk3_file(pk3, "maps/%s.bsp" % map_name, make_bsp(rng, shaders, surface_count, entity_count))
+    if shader_count > 0:
+      write_pk3_file(pk3, "scripts/synthetic%05i.shader" % shader_start, make_shader_script(rng, shader_start,
+                     shader_count, textures=texture_pool))
+    for index in range(texture_start, texture_start + texture_count):
+      write_pk3_file(pk3, "%s.tga" % texture_name(index), bytes(rng.randrange(64, 256)))
+  return output.getvalue()
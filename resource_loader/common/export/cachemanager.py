@@ -0,0 +1,91 @@
+"""
+Tracks usage of resource loader cache entries and removes stale entries to keep the cache
+within a size budget.
+"""
+
+from ..utils import misc
+import os
+import time
+
+class CacheEntry():
+  def __init__(self, rel_path:str, stat:os.stat_result, last_used:float):
+    self.rel_path = rel_path
+    self.size = stat.st_size
+    self.inode = (stat.st_dev, stat.st_ino)
+    self.last_used = last_used
+
+class CacheManager():
+  """ Maintains last-use times of cache entries across exports. Entries are files in the
+  subdirectories below, identified by path relative to the cache directory. """
+  entry_dirs = ("resources", "pk3info", "pk3resource_bsp", "pk3resource_aas")
+  usage_file = "cache_usage.json"
+
+  def __init__(self, cache_dir:misc.DirectoryHandler):
+    self.cache_dir = cache_dir
+    self.usage : dict[str, float] = cache_dir.read_json(self.usage_file) or {}
+    self.used : set[str] = set()
+
+  def mark_used(self, rel_path:str):
+    """ Record cache entry as used by the current export. """
+    self.used.add(rel_path)
+
+  def save(self):
+    now = time.time()
+    for rel_path in self.used:
+      self.usage[rel_path] = now
+    self.cache_dir.write_json(self.usage_file, self.usage, sort_keys=True, indent=2)
+
+  def get_entries(self) -> list[CacheEntry]:
+    entries : list[CacheEntry] = []
+    for entry_dir in self.entry_dirs:
+      dir_path = self.cache_dir.get_read_path(entry_dir)
+      if not os.path.exists(dir_path):
+        continue
+      with os.scandir(dir_path) as it:
+        for dir_entry in it:
+          if dir_entry.is_file():
+            rel_path = entry_dir + "/" + dir_entry.name
+            stat = dir_entry.stat()
+            entries.append(CacheEntry(rel_path, stat, self.usage.get(rel_path, stat.st_mtime)))
+    return entries
+
+  @staticmethod
+  def get_linked_inodes(paths:list[str]) -> set[tuple[int, int]]:
+    """ Returns inodes of all files in the given directory trees. """
+    inodes : set[tuple[int, int]] = set()
+    for path in paths:
+      for dir_path, _, filenames in os.walk(path):
+        for filename in filenames:
+          stat = os.stat(os.path.join(dir_path, filename))
+          inodes.add((stat.st_dev, stat.st_ino))
+    return inodes
+
+  def collect(self, size_budget:int, data_paths:list[str], logger:misc.Logger, dry_run:bool=False):
+    """ Delete entries that are neither used by the current export nor linked from the given
+    data directories, least recently used first, until total cache size is within budget. """
+    entries = self.get_entries()
+    total_size = sum(entry.size for entry in entries)
+    linked_inodes = self.get_linked_inodes(data_paths)
+    candidates = [entry for entry in entries if entry.rel_path not in self.used and
+                  entry.inode not in linked_inodes]
+    candidates.sort(key=lambda entry: entry.last_used)
+
+    logger.log_info("Cache size %i bytes in %i entries; budget %i bytes; %i entries not in use" %
+      (total_size, len(entries), size_budget, len(candidates)), True)
+
+    removed_count = 0
+    for entry in candidates:
+      if total_size <= size_budget:
+        break
+      logger.log_info("%s %s (%i bytes, last used %s)" % ("would remove" if dry_run else "removing",
+        entry.rel_path, entry.size, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.last_used))))
+      if not dry_run:
+        os.remove(self.cache_dir.get_read_path(entry.rel_path))
+        self.usage.pop(entry.rel_path, None)
+      total_size -= entry.size
+      removed_count += 1
+
+    logger.log_info("%s %i entries; cache size %i bytes" % ("Dry run: would remove" if dry_run else "Removed",
+      removed_count, total_size), True)
+    if total_size > size_budget:
+      logger.log_warning("cache size exceeds budget with all unused entries removed")
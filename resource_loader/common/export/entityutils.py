@@ -88,6 +88,154 @@ def run_entity_edit(entities:game_parse.Entities, edits:list[list[dict]], logger
 
   entities.entities = new_entities
 
+q3_weapon_to_ammo = {
+  "weapon_shotgun": "ammo_shells",
+  "weapon_machinegun": "ammo_bullets",
+  "weapon_grenadelauncher": "ammo_grenades",
+  "weapon_rocketlauncher": "ammo_rockets",
+  "weapon_lightning": "ammo_lightning",
+  "weapon_railgun": "ammo_slugs",
+  "weapon_plasmagun": "ammo_cells",
+  "weapon_bfg": "ammo_bfg",
+  "weapon_nailgun": "ammo_nails",
+  "weapon_prox_launcher": "ammo_mines",
+  "weapon_chaingun": "ammo_belt",
+}
+
+ef_weapon_to_ammo = {
+  "weapon_compressionrifle": "ammo_compressionrifle",
+  "weapon_imod": "ammo_imod",
+  "weapon_scavenger": "ammo_scavenger",
+  "weapon_stasisweapon": "ammo_stasis",
+  "weapon_grenadelauncher": "ammo_grenades",
+  "weapon_tetriondisruptor": "ammo_tetriondisruptor",
+  "weapon_quantumburst": "ammo_quantumburst",
+  "weapon_dreadnought": "ammo_dreadnought",
+}
+
+q3_base_translations = {
+  "item_health_small": "item_hypo_small",
+  "item_health": "item_hypo",
+  "item_health_large": "item_hypo",
+  "item_health_mega": "item_regen",
+  "holdable_teleporter": "holdable_transporter",
+  "holdable_kamikaze": "holdable_detpack",
+  "holdable_portal": "holdable_detpack",
+  "holdable_invulnerability": "holdable_shield",
+  "item_scout": "item_haste",
+  "item_guard": "item_regen",
+  "item_doubler": "item_quad",
+  "item_ammoregen": "item_seeker",
+  "weapon_gauntlet": "",
+  "weapon_shotgun": "weapon_scavenger",
+  "weapon_machinegun": "",
+  "weapon_railgun": "weapon_compressionrifle",
+  "weapon_grenadelauncher": "weapon_grenadelauncher",
+  "weapon_rocketlauncher": "weapon_quantumburst",
+  "weapon_lightning": "weapon_dreadnought",
+  "weapon_plasmagun": "weapon_tetriondisruptor",
+  "weapon_bfg": "weapon_quantumburst",
+  "weapon_grapplinghook": "",
+  "weapon_nailgun": "weapon_stasisweapon",
+  "weapon_prox_launcher": "weapon_grenadelauncher",
+  "weapon_chaingun": "weapon_tetriondisruptor",
+}
+
+q3_painkeep_translations = {
+  "holdable_radiate": "item_seeker",
+  "holdable_sentry": "holdable_detpack",
+  "weapon_beans": "holdable_medkit",
+  "weapon_gravity": "holdable_shield",
+}
+
+def get_q3_convert_mode(server_fields:dict) -> str|None:
+  """ Returns entity conversion mode matching the lua_entityConvertType value the server
+  would set for this map, or None if no conversion is configured. """
+  if server_fields.get("entity_type_painkeep"):
+    return "painkeep"
+  if server_fields.get("entity_type_quake3"):
+    return "quake3"
+  return None
+
+def convert_q3_entities(entities:game_parse.Entities, mode:str, logger:misc.Logger|None) -> bool:
+  """ Convert Q3 entities to EF, equivalent to scripts/server/entities/q3convert.lua.
+  Returns False without making changes if the result would depend on the gametype
+  selected at runtime, in which case conversion is left to the server. """
+  assert mode in ("quake3", "painkeep")
+
+  def to_integer(value:str) -> int:
+    # Approximation of utils.to_integer
+    try:
+      return int(float(value))
+    except (ValueError, OverflowError):
+      pass
+    try:
+      return int(value.strip(), 0)
+    except ValueError:
+      return 0
+
+  if any(entity.get("gametype") != None for entity in entities.entities):
+    if logger:
+      logger.log_info("skipping q3 entity conversion due to gametype-specific entities")
+    return False
+
+  translations = dict(q3_base_translations)
+  if mode == "painkeep":
+    translations.update(q3_painkeep_translations)
+  for q3_weapon, q3_ammo in q3_weapon_to_ammo.items():
+    translations[q3_ammo] = ef_weapon_to_ammo.get(translations.get(q3_weapon, ""), "")
+
+  messages : dict[str, int] = {}
+  def add_message(msg:str):
+    messages[msg] = messages.get(msg, 0) + 1
+
+  def convert(entity:game_parse.Entity) -> bool:
+    """ Returns False if entity should be dropped. """
+    if to_integer(entity.get("notta", "0")) != 0:
+      add_message("skipping notta entity")
+      return False
+
+    classname = entity.get("classname")
+    if classname in translations:
+      if not translations[classname]:
+        return False
+      classname = translations[classname]
+      entity.set("classname", classname)
+
+    if entity.get("noise") == "*taunt.wav":
+      add_message("changing *taunt.wav to *taunt1.wav")
+      entity.set("noise", "*taunt1.wav")
+
+    if (team := entity.get("team")) != None:
+      add_message("prefixing team parameter")
+      entity.set("team", "team_" + team)
+
+    if classname == "func_plat" and entity.fields.pop("wait", None):
+      add_message("clearing wait for func_plat")
+
+    if classname == "target_location":
+      nonlocal location_count
+      location_count += 1
+      if location_count > 340:
+        add_message("skipping excessive number of location tags")
+        return False
+
+    if mode == "painkeep" and classname in ("holdable_medkit", "holdable_detpack", "holdable_shield"):
+      if entity.fields.pop("spawnflags", None):
+        add_message("clearing spawnflags parameter on painkeep holdable")
+      if entity.fields.pop("wait", None):
+        add_message("clearing wait parameter on painkeep holdable")
+
+    return True
+
+  location_count = 0
+  entities.entities = [entity for entity in entities.entities if convert(entity)]
+
+  if logger:
+    for msg, count in messages.items():
+      logger.log_info("q3 entity conversion: %s [x%i]" % (msg, count))
+  return True
+
 def get_entity_info(entities:game_parse.Entities) -> dict:
   """ Returns entity data to add to server map info. """
   classnames = {}
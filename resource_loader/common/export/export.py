@@ -6,24 +6,43 @@ from ..utils import misc
 from ..utils import pk3_data
 from ..utils import dependency_resolver
 from ..utils import game_parse
+from ..utils import metrics
+from ..utils import profiling
 from . import entityutils
+from . import cachemanager
+import collections
+import concurrent.futures
+import itertools
 import json
 import zipfile
 import os
 import shutil
 import typing
 import copy
+import hashlib
 
 class Manifest():
+  # Fields where new values are merged with old ones instead of replacing them
+  merge_fields = ("client_paks", "server_fields", "music_extension_patch")
+
+  # Base for merges that don't have old info, shared so profile merges onto it can be cached
+  empty_info : dict = {}
+
   def __init__(self):
     self.resource_urls : set[str] = set()
     self.profiles : dict[str, dict] = {}
     self.paks : dict[str, dict] = {}
     self.server_resources : dict[str, dict] = {}
     self.custom_pak_dirs : dict[str, dict] = {}
+    # (profile name, id of base info) => (base info, merged info)
+    self.profile_merge_cache : dict[tuple[str, int], tuple[dict, dict]] = {}
+    # pak name => result of resolve_pak_mapcfgs, if precomputed by resolve_all
+    self.resolved_mapcfgs : dict[str, tuple[dict, dict[str, list[dict]]]] = {}
 
   def import_manifest(self, data:dict):
     """ Load data from manifest. Last manifest loaded has precedence. """
+    self.profile_merge_cache.clear()
+    self.resolved_mapcfgs.clear()
     self.resource_urls.update(data.get("resource_urls", []))
     misc.update_delete_null(data.get("paks", {}), self.paks)
     misc.update_delete_null(data.get("server_resources", {}), self.server_resources)
@@ -31,34 +50,103 @@ class Manifest():
     for profile_name, profile in data.get("profiles", {}).items():
       out = self.profiles.setdefault(profile_name, {})
       for key, value in profile.items():
-        if key in ("client_paks", "server_fields", "music_extension_patch"):
+        if key in self.merge_fields:
           out.setdefault(key, {}).update(value)
         else:
           out[key] = value
 
-  def merge_map_info(self, new_info:dict, old_info:dict={}):
-    """ Merges new_info on top of old_info. """
-    output = copy.deepcopy(old_info)
-    new_info = copy.deepcopy(new_info)
+  def merge_map_info(self, new_info:dict, old_info:dict=empty_info):
+    """ Merges new_info on top of old_info. Neither input is modified. The result shares
+    unchanged values with the inputs and may be returned again for identical merges, so it
+    should be treated as read-only. """
+    output = old_info
 
     # Handle purge_all command, to ignore all old info
-    if new_info.pop("purge_all", False):
-      output.clear()
-    
+    if new_info.get("purge_all", False):
+      output = self.empty_info
+
     # Handle profile imports
-    if profile_name := new_info.pop("import", None):
-      output = self.merge_map_info(self.profiles[profile_name], output)
+    if profile_name := new_info.get("import", None):
+      output = self.merge_profile(profile_name, output)
+
+    return self.merge_fields_over(new_info, output)
+
+  def merge_profile(self, profile_name:str, old_info:dict):
+    """ Merges profile on top of old_info. Results are cached, since the same profiles are
+    merged onto the same base for many pk3s and maps. """
+    key = (profile_name, id(old_info))
+    if cached := self.profile_merge_cache.get(key):
+      return cached[1]
+    output = self.merge_map_info(self.profiles[profile_name], old_info)
+    # Store old_info with the result so its id can't be reused while cached
+    self.profile_merge_cache[key] = (old_info, output)
+    return output
+
+  def merge_fields_over(self, new_info:dict, old_info:dict):
+    """ Merges fields of new_info other than purge_all and import on top of old_info,
+    copying only the parts of old_info that change. """
+    if not any(key not in ("purge_all", "import") for key in new_info):
+      return old_info
+    output = dict(old_info)
 
     # Handle certain fields that are merged individually
-    for merge_field in ("client_paks", "server_fields", "music_extension_patch"):
-      if new_info.pop("purge_" + merge_field, False):
+    for merge_field in self.merge_fields:
+      if new_info.get("purge_" + merge_field, False):
         output.pop(merge_field)
-      if data := new_info.pop(merge_field, None):
-        misc.update_delete_null(data, output.setdefault(merge_field, {}))
+      if data := new_info.get(merge_field, None):
+        merged = dict(output.get(merge_field, {}))
+        misc.update_delete_null(data, merged)
+        output[merge_field] = merged
 
-    output.update(new_info)
+    skip_fields = ("purge_all", "import", *self.merge_fields, *("purge_" + field for field in self.merge_fields))
+    output.update((key, value) for key, value in new_info.items() if key not in skip_fields)
     return output
 
+  def resolve_pak_mapcfgs(self, manifest_info:dict) -> tuple[dict, dict[str, list[dict]]]:
+    """ Returns merged mapcfg for pk3, and merged mapcfgs for each version of each bsp with
+    a "mapcfg_<name>" entry, by bsp name. Bsps without an entry use the pk3 mapcfg. """
+    pk3_mapcfg = self.merge_map_info(self.profiles.get(manifest_info.get("profile", None), {}))
+    pk3_mapcfg = self.merge_map_info(manifest_info.get("mapcfg", {}), pk3_mapcfg)
+    map_configs : dict[str, list[dict]] = {}
+    for key, mapcfg in manifest_info.items():
+      if key.startswith("mapcfg_"):
+        versions = mapcfg.get("versions", [{}])
+        mapcfg = self.merge_map_info({field: value for field, value in mapcfg.items() if field != "versions"}, pk3_mapcfg)
+        map_configs[key[len("mapcfg_"):]] = [self.merge_map_info(version, mapcfg) for version in versions]
+    return pk3_mapcfg, map_configs
+
+  def resolve_all(self):
+    """ Precompute mapcfgs for all paks in manifest. """
+    self.resolved_mapcfgs = {pak_name: self.resolve_pak_mapcfgs(manifest_info)
+                             for pak_name, manifest_info in self.paks.items()}
+
+  def get_pak_mapcfgs(self, pak_name:str, manifest_info:dict) -> tuple[dict, dict[str, list[dict]]]:
+    """ Returns result of resolve_pak_mapcfgs, using precomputed result if available. """
+    # Custom paks may share a name with a manifest pak, so check the info matches
+    if (resolved := self.resolved_mapcfgs.get(pak_name)) and self.paks.get(pak_name) is manifest_info:
+      return resolved
+    return self.resolve_pak_mapcfgs(manifest_info)
+
+  def export_snapshot(self) -> dict:
+    return {
+      "resource_urls": self.resource_urls,
+      "profiles": self.profiles,
+      "paks": self.paks,
+      "server_resources": self.server_resources,
+      "custom_pak_dirs": self.custom_pak_dirs,
+      "resolved_mapcfgs": self.resolved_mapcfgs,
+    }
+
+  def import_snapshot(self, snapshot:dict):
+    """ Replace manifest contents with data from export_snapshot. """
+    self.profile_merge_cache.clear()
+    self.resource_urls = snapshot["resource_urls"]
+    self.profiles = snapshot["profiles"]
+    self.paks = snapshot["paks"]
+    self.server_resources = snapshot["server_resources"]
+    self.custom_pak_dirs = snapshot["custom_pak_dirs"]
+    self.resolved_mapcfgs = snapshot["resolved_mapcfgs"]
+
 ResourceHash = str
 
 class FileFromPk3():
@@ -135,6 +223,36 @@ class FileExporter():
     return '\n'.join(["%s - %s" % (res_hash, str(list(descriptions))) \
               for res_hash, descriptions in self.mirror_written.items()])
 
+class DedupZipWriter():
+  """ Writes files to zip under content hash names, storing identical content only once. """
+  def __init__(self, zip_file:zipfile.ZipFile|misc.BackgroundZipWriter, directory:str, extension:str):
+    self.zip_file = zip_file
+    self.directory = directory
+    self.extension = extension
+    self.written : set[str] = set()
+    self.write_count = 0
+    self.write_bytes = 0
+    self.dedup_count = 0
+    self.dedup_bytes = 0
+
+  def write(self, data:bytes) -> str:
+    """ Writes data if not already present. Returns path of file within zip. """
+    content_hash = hashlib.sha256(data).hexdigest()
+    path = "%s/%s.%s" % (self.directory, content_hash, self.extension)
+    if content_hash in self.written:
+      self.dedup_count += 1
+      self.dedup_bytes += len(data)
+    else:
+      self.zip_file.writestr(path, data)
+      self.written.add(content_hash)
+      self.write_count += 1
+      self.write_bytes += len(data)
+    return path
+
+  def get_stats_str(self) -> str:
+    return "%i files written (%i bytes), %i duplicates skipped (%i bytes)" % \
+      (self.write_count, self.write_bytes, self.dedup_count, self.dedup_bytes)
+
 class Pk3Source():
   """ Represents a single source pk3 being processed. """
   def get_info(self):
@@ -164,13 +282,25 @@ class Pk3Source():
   def __str__(self):
     return "pk3|" + self.full_name
 
+class PendingPk3():
+  """ Pk3 queued for loading. Path is set for custom paks that are already available. """
+  def __init__(self, pak_name:str, res_hash:ResourceHash, manifest_info:dict, path:str|None=None):
+    self.pak_name = pak_name
+    self.res_hash = res_hash
+    self.manifest_info = manifest_info
+    self.path = path
+
 class Pk3Sources():
   """ Represents source pk3s being processed. """
   def __init__(self):
     # pk3 name in "baseEF/pak0" format => Pk3 object
     self.pk3s : dict[str, Pk3Source] = {}
+    # pk3s to load, in load order
+    self.queue : dict[str, PendingPk3] = {}
 
-  def load_from_custom_dirs(self, manifest:Manifest, base_dir:misc.DirectoryHandler, cache_dir:misc.DirectoryHandler, logger:misc.Logger):
+  def queue_custom_dirs(self, manifest:Manifest, base_dir:misc.DirectoryHandler, cache_dir:misc.DirectoryHandler):
+    # Locate pk3s; pak name => (file path, manifest entry)
+    custom_paks : dict[str, tuple[str, dict]] = {}
     for dir_name, manifest_entry in manifest.custom_pak_dirs.items():
       dir_path = base_dir.get_subdir(dir_name)
       for filename in os.listdir(dir_path.path):
@@ -179,37 +309,76 @@ class Pk3Sources():
           continue
         pak_name = manifest_entry["mod_dir"] + "/" + split[0].lower()
 
-        if pak_name in self.pk3s:
+        if pak_name in self.queue or pak_name in custom_paks:
           # already loaded
           continue
 
-        print("Loading custom pk3 '%s'" % pak_name)
+        custom_paks[pak_name] = (dir_path.get_read_path(filename), manifest_entry)
 
-        file_path = dir_path.get_read_path(filename)
-        hash = misc.file_sha256(file_path)
+    # Get hashes, skipping files that are unchanged since the last export
+    hash_cache = misc.FileHashCache(cache_dir.get_write_path("custom_pak_hashes.json"))
+    hashes = hash_cache.get_hashes([file_path for file_path, _ in custom_paks.values()])
+    hash_cache.save()
 
-        # copy pk3 to cache if needed
-        cache_path = cache_dir.get_write_path(os.path.join("resources", hash))
-        if not os.path.exists(cache_path):
-          shutil.copy(file_path, cache_path)
+    for (pak_name, (file_path, manifest_entry)), hash in zip(custom_paks.items(), hashes):
+      # copy pk3 to cache if needed
+      cache_path = cache_dir.get_write_path(os.path.join("resources", hash))
+      if not os.path.exists(cache_path):
+        # Copy to temporary file first, so an interrupted copy isn't left under the hash
+        temp_path = cache_path + ".tmp"
+        misc.reflink_or_copy(file_path, temp_path)
+        os.replace(temp_path, cache_path)
 
-        manifest_info = {**manifest_entry, "sha256": hash}
-        self.pk3s[pak_name] = Pk3Source(pak_name, cache_path, hash, manifest_info, cache_dir)
-  
-  def load_from_manifest(self, manifest:Manifest, file_importer:FileImporter, cache_dir:misc.DirectoryHandler, logger:misc.Logger):
+      manifest_info = {**manifest_entry, "sha256": hash}
+      self.queue[pak_name] = PendingPk3(pak_name, hash, manifest_info, cache_path)
+
+  def queue_manifest(self, manifest:Manifest):
     for pak_name, manifest_info in manifest.paks.items():
-      if pak_name in self.pk3s:
+      if pak_name in self.queue:
         # already loaded
         continue
-
-      print("Loading pk3 '%s'" % pak_name)
-      
-      hash = manifest_info["sha256"]
-      try:
-        full_path = file_importer.get_path(hash)
-        self.pk3s[pak_name] = Pk3Source(pak_name, full_path, hash, manifest_info, cache_dir)
-      except Exception as ex:
-        logger.log_warning(f"Error loading pk3 '{pak_name}' with hash '{hash}': '{ex}'")
+      self.queue[pak_name] = PendingPk3(pak_name, manifest_info["sha256"], manifest_info)
+
+  def load(self, file_importer:FileImporter, cache_dir:misc.DirectoryHandler, logger:misc.Logger,
+           download_threads:int=4, read_ahead:int=32) -> typing.Iterator[tuple[str, Pk3Source|None]]:
+    """ Loads queued pk3s, yielding name and pk3 (or None if loading failed) in queue order.
+    Downloads run on a thread pool and indexing on a background thread, up to read_ahead pk3s
+    ahead of the caller. """
+    def index(pending:PendingPk3, path_future:concurrent.futures.Future) -> Pk3Source:
+      return Pk3Source(pending.pak_name, path_future.result(), pending.res_hash, pending.manifest_info, cache_dir)
+
+    with concurrent.futures.ThreadPoolExecutor(download_threads) as download_executor, \
+         concurrent.futures.ThreadPoolExecutor(1) as index_executor:
+      # Paks can share a hash, so only fetch each resource once
+      path_futures : dict[ResourceHash, concurrent.futures.Future] = {}
+      active : collections.deque[tuple[PendingPk3, concurrent.futures.Future]] = collections.deque()
+
+      def submit(pending:PendingPk3):
+        if not pending.res_hash in path_futures:
+          path_futures[pending.res_hash] = download_executor.submit(
+            lambda: pending.path or file_importer.get_path(pending.res_hash))
+        active.append((pending, index_executor.submit(index, pending, path_futures[pending.res_hash])))
+
+      pending_iter = iter(self.queue.values())
+      for pending in itertools.islice(pending_iter, read_ahead):
+        submit(pending)
+
+      while active:
+        pending, future = active.popleft()
+        if (next_pending := next(pending_iter, None)) != None:
+          submit(next_pending)
+
+        print("Loading %spk3 '%s'" % ("" if pending.path == None else "custom ", pending.pak_name))
+        try:
+          pk3 = future.result()
+        except Exception as ex:
+          if pending.path != None:
+            raise
+          logger.log_warning(f"Error loading pk3 '{pending.pak_name}' with hash '{pending.res_hash}': '{ex}'")
+          yield pending.pak_name, None
+          continue
+        self.pk3s[pending.pak_name] = pk3
+        yield pending.pak_name, pk3
 
 def write_resource_pk3(read, cache_dir:misc.DirectoryHandler, resource_hash:str,
       resource_type:str) -> tuple[str, str]:
@@ -227,9 +396,41 @@ def write_resource_pk3(read, cache_dir:misc.DirectoryHandler, resource_hash:str,
       tgt.writestr(internal_name, data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=4)
   return full_path, internal_name
 
-def run_export(manifest:Manifest, output_path:str, custom_paks_path:str|None=None, keep_old_mirror:bool=False):
+def write_map_index(info_zip:zipfile.ZipFile|misc.BackgroundZipWriter, map_records:dict[str, str]):
+  """ Writes consolidated map index and record file to map info pk3. Index contains fields
+  needed for map listing and filtering, plus the byte offset and length of the full record
+  for each map within the record file, so all map info can be accessed with two file reads. """
+  records_file = "mapdb_index/records.txt"
+  index : dict[str, dict] = {}
+  records : list[str] = []
+  offset = 0
+  for map_name in sorted(map_records):
+    record = map_records[map_name]
+    info = json.loads(record)
+    index[map_name] = {
+      "botsupport": info.get("botsupport", False),
+      "classnames": info.get("classnames", {}),
+      "offset": offset,
+      "length": len(record),
+    }
+    records.append(record)
+    offset += len(record) + 1
+
+  info_zip.writestr(records_file, '\n'.join(records))
+  info_zip.writestr("mapdb_index/index.json", json.dumps({"records_file": records_file,
+    "maps": index}, sort_keys=True, separators=(',', ':')))
+
+def run_export(manifest:Manifest, output_path:str, custom_paks_path:str|None=None, keep_old_mirror:bool=False,
+               cache_size_budget:int|None=None, cache_gc_dry_run:bool=False,
+               profiler:profiling.PhaseProfiler|None=None):
+  """ Runs export. If cache_size_budget is set, cache entries not used by this export or the
+  previous one are removed, least recently used first, to keep the cache within budget.
+  If profiler is set, it is applied to phases recorded in the export metrics, and the
+  caller is responsible for calling its finish(). """
   base_dir = misc.DirectoryHandler(output_path)
   cache_dir = base_dir.get_subdir("cache")
+  cache_manager = cachemanager.CacheManager(cache_dir)
+  export_metrics = metrics.Metrics(profiler)
   data_out_dir = base_dir.get_subdir("data_new")
 
   # Clear temporary directories
@@ -239,10 +440,16 @@ def run_export(manifest:Manifest, output_path:str, custom_paks_path:str|None=Non
 
   # Set up logging
   log_zip = zipfile.ZipFile(data_out_dir.get_write_path("logs.zip"), "w")
-  index_logger = misc.Logger()
-  download_logger = misc.Logger()
-  warnings_out : list[str] = []
-  unresolved_info_out : list[str] = []
+  # Run-wide logs are spooled to temporary files, since only one zip member can be written at a time
+  index_log = misc.SpoolLogSink()
+  download_log = misc.SpoolLogSink()
+  warnings_log = misc.SpoolLogSink()
+  unresolved_log = misc.SpoolLogSink()
+  index_logger = misc.Logger(keep_messages=False)
+  index_logger.add_sink(index_log, misc.Logger.TYPE_INFO)
+  index_logger.add_sink(warnings_log, misc.Logger.TYPE_WARNING)
+  download_logger = misc.Logger(keep_messages=False)
+  download_logger.add_sink(download_log, misc.Logger.TYPE_INFO)
 
   # Set up file importers
   downloader = misc.ResourceDownloader(manifest.resource_urls, download_logger)
@@ -255,27 +462,56 @@ def run_export(manifest:Manifest, output_path:str, custom_paks_path:str|None=Non
   # Get available pk3s
   pk3_sources = Pk3Sources()
   if custom_paks_path:
-    pk3_sources.load_from_custom_dirs(manifest, misc.DirectoryHandler(custom_paks_path), cache_dir, index_logger)
-  pk3_sources.load_from_manifest(manifest, file_importer, cache_dir, index_logger)
-  index_logger.log_info("Indexed %i pk3s" % len(pk3_sources.pk3s), True)
-
-  # Initialize dependency resolver
+    pk3_sources.queue_custom_dirs(manifest, misc.DirectoryHandler(custom_paks_path), cache_dir)
+  pk3_sources.queue_manifest(manifest)
   dependency_index = dependency_resolver.AssetIndex()
-  for name, pk3 in pk3_sources.pk3s.items():
-    dependency_index.register_assets(name, pk3.dependency_assets)
-    pk3.dependency_assets = None  # type: ignore # release memory
-
-  index_logger.log_info("Initialized pk3 dependency index with %i pk3s" %
-    len(dependency_index.registered_sources))
-  index_logger.log_info("Dependency asset types: " + dependency_index.asset_counts_str())
 
-  info_zip = zipfile.ZipFile(data_out_dir.get_write_path("serverdata/servercfg/mapinfo.pk3"), 'w')
-  entity_zip = zipfile.ZipFile(data_out_dir.get_write_path("serverdata/servercfg/mapentities.pk3"), 'w')
+  def get_ready_pk3s() -> typing.Iterator[tuple[Pk3Source, dict, dict[str, list[dict]]]]:
+    """ Registers pk3s in the dependency index in load order as they are loaded, and yields
+    each pk3 with its mapcfgs once every pk3 its client paks can reference has been loaded. """
+    load_order = {pak_name: index for index, pak_name in enumerate(pk3_sources.queue)}
+    # (pk3, mapcfgs, load index of last pk3 referenced by client paks)
+    waiting : collections.deque[tuple[Pk3Source, dict, dict[str, list[dict]], int]] = collections.deque()
+    loader = pk3_sources.load(file_importer, cache_dir, index_logger)
+    load_index = 0
+    while True:
+      with export_metrics.phase("pk3_load") as stats:
+        if (result := next(loader, None)) == None:
+          break
+        pak_name, pk3 = result
+        if pk3:
+          stats.items += 1
+
+      if pk3:
+        with export_metrics.phase("asset_index") as stats:
+          dependency_index.register_assets(pak_name, pk3.dependency_assets)
+          stats.items += sum(len(asset_list) for asset_list in pk3.dependency_assets.values())
+          pk3.dependency_assets = None  # type: ignore # release memory
+
+        with export_metrics.phase("manifest_merge"):
+          pk3_mapcfg, map_configs = manifest.get_pak_mapcfgs(pk3.full_name, pk3.manifest_info)
+        mapcfgs = [pk3_mapcfg, *(config for versions in map_configs.values() for config in versions)]
+        last_reference = max((load_order.get(client_pak, -1) for mapcfg in mapcfgs
+                              for client_pak in mapcfg.get("client_paks", {})), default=-1)
+        waiting.append((pk3, pk3_mapcfg, map_configs, last_reference))
+
+      while waiting and waiting[0][3] <= load_index:
+        yield waiting.popleft()[:3]
+      load_index += 1
+
+    while waiting:
+      yield waiting.popleft()[:3]
+
+  # Written from background threads so archive writes overlap with map processing
+  info_zip = misc.BackgroundZipWriter(zipfile.ZipFile(data_out_dir.get_write_path("serverdata/servercfg/mapinfo.pk3"), 'w'))
+  entity_zip = misc.BackgroundZipWriter(zipfile.ZipFile(data_out_dir.get_write_path("serverdata/servercfg/mapentities.pk3"), 'w'))
+  entity_writer = DedupZipWriter(entity_zip, "mapdb_ent", "ent")
 
   bsp_resources_written : dict[str, str] = {}   # hash -> pk3 internal name
   aas_resources_written : dict[str, str] = {}   # hash -> pk3 internal name
   map_duplicate_check : dict[str, str] = {}   # map name => source pk3 name
   map_unreplaced_check : dict[str, str] = {}  # map name => source pk3 name
+  map_records : dict[str, str] = {}   # map name => encoded map info
 
   def read_external_or_pk3_resource(res_hash:ResourceHash):
     if (result := file_from_pk3_loader.read(res_hash)) != None:
@@ -301,178 +537,189 @@ def run_export(manifest:Manifest, output_path:str, custom_paks_path:str|None=Non
 
     print("Processing map '%s' from '%s'" % (map_name, map_pk3.full_name))
 
-    map_logger = misc.Logger()
-
-    try:
-      if bsp_hash := mapcfg.get("bsp"):
-        assert isinstance(bsp_hash, str)
-        file_exporter.write_mirror_resource(bsp_hash, file_importer, "custom bsp")
-        bsp_info = pk3_data.get_bsp_info(file_importer.get_data(bsp_hash))
-      else:
-        bsp_hash = subfile["sha256"]
-        bsp_info = subfile["bspinfo"]
-      # pass on warnings from bsp info
-      for warning in bsp_info["warnings"]:
-        map_logger.log_warning(f"bsp warning: {warning}")
-
-      if aas_hash := mapcfg.get("aas"):
-        assert isinstance(aas_hash, str)
-        # make sure resource is exported
-        file_exporter.write_mirror_resource(aas_hash, file_importer, "custom aas")
-      elif source_bsp_name in aas_table:
-        aas_hash = aas_table[source_bsp_name]
-      else:
-        aas_hash = None
-
-      # Get entities
-      entities = game_parse.Entities()
-      if ent_hash := mapcfg.get("ent"):
-        assert isinstance(ent_hash, str)
-        entity_text = file_importer.get_data(ent_hash)
-        file_exporter.write_mirror_resource(ent_hash, file_importer, "custom entities")
-        assert entity_text
-        entities.import_text(entity_text)
-      else:
-        entities.import_serializable(bsp_info["entities"])
-
-      log_zip.writestr(f"mapcfg/{map_name}.json", json.dumps(mapcfg, indent=2))
-
-      info_out = {
-        "client_bsp": source_bsp_name,
-      }
-
-      info_out.update(mapcfg.get("server_fields", {}))
-
-      # Perform entity processing
-      map_logger.log_info("processing entities")
-      if mapcfg.get("patch_q3_entity_key_case"):
-        entityutils.patch_q3_key_case(entities, map_logger)
-      entityutils.patch_music_extensions(entities, mapcfg.get("music_extension_patch", {}), map_logger)
-      entityutils.run_entity_edit(entities, mapcfg.get("entity_edit", []), map_logger)
-      map_logger.log_info("")
-
-      # Add entities
-      entity_path = "mapdb_ent/%s.ent" % map_name
-      entity_zip.writestr(entity_path, entities.export_text())
-      info_out["ent_file"] = entity_path
-
-      # Add entity info
-      info_out.update(entityutils.get_entity_info(entities))
-
-      # Add bsp resource
-      if not bsp_hash in bsp_resources_written:
-        resource_pk3, resource_internal_name = write_resource_pk3(read_external_or_pk3_resource, cache_dir, bsp_hash, "bsp")
-        os.link(resource_pk3, data_out_dir.get_write_path("serverdata/servercfg/bsp_%s.pk3" % bsp_hash))
-        bsp_resources_written[bsp_hash] = resource_internal_name
-      info_out["bsp_file"] = bsp_resources_written[bsp_hash]
-
-      # Add aas resource
-      if aas_hash:
-        if not aas_hash in aas_resources_written:
-          resource_pk3, resource_internal_name = write_resource_pk3(read_external_or_pk3_resource, cache_dir, aas_hash, "aas")
-          os.link(resource_pk3, data_out_dir.get_write_path("serverdata/servercfg/aas_%s.pk3" % aas_hash))
-          aas_resources_written[aas_hash] = resource_internal_name
-        info_out["aas_file"] = aas_resources_written[aas_hash]
-        info_out["botsupport"] = True
-      else:
-        info_out["botsupport"] = False
-
-      # Get sorted list of pak references from manifest
-      """ Fields from manifest:
-        pak_name: str
-        priority: numeric
-        download: "yes", "no", "auto"
-        pure: "yes", "no", "auto"
-        dep_group: numeric
-        pure_sort: str """
-      manifest_paks = [{"pak_name": pak_name, **info} for pak_name, info in mapcfg["client_paks"].items()]
-      manifest_paks.sort(key = lambda x: x["priority"], reverse=True)
-
-      # Generate temporary client pak info, with *map_pak special entry replaced and deduplicated
-      client_paks_temp = []
-      client_paks_added = set()
-      for client_pak in copy.deepcopy(manifest_paks):
-        if client_pak["pak_name"] == "*map_pak":
-          client_pak["pak_name"] = map_pk3.full_name
-        if client_pak["pak_name"] in client_paks_added:
-          continue
-        client_paks_added.add(client_pak["pak_name"])
-        if not client_pak["pak_name"] in pk3_sources.pk3s:
-          map_logger.log_warning(f"referenced unindexed pk3 '{client_pak['pak_name']}'")
-          continue
-        client_paks_temp.append(client_pak)
-
-      # Run dependency calculation
-      source_list = dependency_resolver.SourceList(dependency_index)
-      for client_pak in client_paks_temp:
-        if "dep_group" in client_pak:
-          source_list.add_source(client_pak["pak_name"], client_pak["dep_group"])
-      dependency_pool = dependency_resolver.DependencyPool()
-      dependency_pool.add_bsp_dependencies(bsp_info)
-      for warning in dependency_pool.warnings:
-        map_logger.log_warning(f"dependency warning: {warning}")
-      res = dependency_resolver.resolve_dependencies(dependency_pool, source_list)
-      needed_sources = dependency_resolver.get_minimum_sources(res, source_list)
-
-      # Log dependency info
-      dependency_resolver.log_dependencies(res, needed_sources, map_logger)
-      unsatisfied = dependency_resolver.get_unsatisfied(res, False)
-      for depdendency in unsatisfied.keys():
-        unresolved_info_out.append(f"{map_name}: {depdendency}")
-      unresolved_count = len(unsatisfied)
-      if unresolved_count > 0:
-        map_logger.log_info(f"{unresolved_count} unresolved dependencies")
-
-      # Generate output client pak info
-      client_paks_out : list[dict] = []
-
-      for client_pak in client_paks_temp:
-        client_pk3_source : Pk3Source = pk3_sources.pk3s[client_pak["pak_name"]]
-        referenced : bool = client_pak["pak_name"] in needed_sources
-        download : bool = client_pak["download"] == "yes" or (client_pak["download"] == "auto" and referenced)
-        pure : bool = client_pak["pure"] == "yes" or (client_pak["pure"] == "auto" and referenced)
-        if not download and not pure:
-          continue
-
-        result = {
-          "pk3_name": client_pak["pak_name"],
-          "pk3_hash": client_pk3_source.pk3_hash,
-          "pk3_source_path": f"{client_pk3_source.mod_dir}/refonly/{client_pk3_source.filename}.pk3",
-          "download": download,
-        }
-
-        if "pure_sort" in client_pak:
-          result["pure_sort"] = client_pak["pure_sort"]
-
-        client_paks_out.append(result)
-
-        if download:
-          file_exporter.write_http(client_pk3_source)
+    map_logger = misc.Logger(keep_messages=False)
+    map_log = misc.zip_log_sink(log_zip, f"maps/{map_name}.txt")
+    map_logger.add_sink(map_log, misc.Logger.TYPE_INFO)
+    map_logger.add_sink(warnings_log, misc.Logger.TYPE_WARNING, f"MAP '{map_name}': ")
+    mapcfg_log : str|None = None
 
-      info_out["client_paks"] = client_paks_out
-
-      info_zip.writestr("mapdb_info/%s.json" % map_name, json.dumps(info_out))
-    except Exception as ex:
-      map_logger.log_warning(f"Error processing map '{map_name}': {misc.error_string(ex)}")
+    with export_metrics.phase("load_map", map_name):
+      try:
+        if bsp_hash := mapcfg.get("bsp"):
+          assert isinstance(bsp_hash, str)
+          file_exporter.write_mirror_resource(bsp_hash, file_importer, "custom bsp")
+          bsp_info = pk3_data.get_bsp_info(file_importer.get_data(bsp_hash))
+        else:
+          bsp_hash = subfile["sha256"]
+          bsp_info = subfile["bspinfo"]
+        # pass on warnings from bsp info
+        for warning in bsp_info["warnings"]:
+          map_logger.log_warning(f"bsp warning: {warning}")
+
+        if aas_hash := mapcfg.get("aas"):
+          assert isinstance(aas_hash, str)
+          # make sure resource is exported
+          file_exporter.write_mirror_resource(aas_hash, file_importer, "custom aas")
+        elif source_bsp_name in aas_table:
+          aas_hash = aas_table[source_bsp_name]
+        else:
+          aas_hash = None
+
+        with export_metrics.phase("load_map/entities", map_name):
+          # Get entities
+          entities = game_parse.Entities()
+          if ent_hash := mapcfg.get("ent"):
+            assert isinstance(ent_hash, str)
+            entity_text = file_importer.get_data(ent_hash)
+            file_exporter.write_mirror_resource(ent_hash, file_importer, "custom entities")
+            assert entity_text
+            entities.import_text(entity_text)
+          else:
+            entities.import_serializable(bsp_info["entities"])
+
+          # Written after map log is closed
+          mapcfg_log = json.dumps(mapcfg, indent=2)
+
+          info_out = {
+            "client_bsp": source_bsp_name,
+          }
+
+          info_out.update(mapcfg.get("server_fields", {}))
+
+          # Perform entity processing
+          map_logger.log_info("processing entities")
+          if mapcfg.get("patch_q3_entity_key_case"):
+            entityutils.patch_q3_key_case(entities, map_logger)
+          entityutils.patch_music_extensions(entities, mapcfg.get("music_extension_patch", {}), map_logger)
+          entityutils.run_entity_edit(entities, mapcfg.get("entity_edit", []), map_logger)
+          if convert_mode := entityutils.get_q3_convert_mode(mapcfg.get("server_fields", {})):
+            if entityutils.convert_q3_entities(entities, convert_mode, map_logger):
+              info_out["entities_preconverted"] = True
+          map_logger.log_info("")
+
+          # Add entities
+          info_out["ent_file"] = entity_writer.write(entities.export_text())
+
+          # Add entity info
+          info_out.update(entityutils.get_entity_info(entities))
+
+        # Add bsp resource
+        with export_metrics.phase("load_map/resource_pk3s", map_name):
+          if not bsp_hash in bsp_resources_written:
+            resource_pk3, resource_internal_name = write_resource_pk3(read_external_or_pk3_resource, cache_dir, bsp_hash, "bsp")
+            os.link(resource_pk3, data_out_dir.get_write_path("serverdata/servercfg/bsp_%s.pk3" % bsp_hash))
+            bsp_resources_written[bsp_hash] = resource_internal_name
+          info_out["bsp_file"] = bsp_resources_written[bsp_hash]
+
+          # Add aas resource
+          if aas_hash:
+            if not aas_hash in aas_resources_written:
+              resource_pk3, resource_internal_name = write_resource_pk3(read_external_or_pk3_resource, cache_dir, aas_hash, "aas")
+              os.link(resource_pk3, data_out_dir.get_write_path("serverdata/servercfg/aas_%s.pk3" % aas_hash))
+              aas_resources_written[aas_hash] = resource_internal_name
+            info_out["aas_file"] = aas_resources_written[aas_hash]
+            info_out["botsupport"] = True
+          else:
+            info_out["botsupport"] = False
+
+        # Get sorted list of pak references from manifest
+        """ Fields from manifest:
+          pak_name: str
+          priority: numeric
+          download: "yes", "no", "auto"
+          pure: "yes", "no", "auto"
+          dep_group: numeric
+          pure_sort: str """
+        manifest_paks = [{"pak_name": pak_name, **info} for pak_name, info in mapcfg["client_paks"].items()]
+        manifest_paks.sort(key = lambda x: x["priority"], reverse=True)
+
+        # Generate temporary client pak info, with *map_pak special entry replaced and deduplicated
+        client_paks_temp = []
+        client_paks_added = set()
+        for client_pak in copy.deepcopy(manifest_paks):
+          if client_pak["pak_name"] == "*map_pak":
+            client_pak["pak_name"] = map_pk3.full_name
+          if client_pak["pak_name"] in client_paks_added:
+            continue
+          client_paks_added.add(client_pak["pak_name"])
+          if not client_pak["pak_name"] in pk3_sources.pk3s:
+            map_logger.log_warning(f"referenced unindexed pk3 '{client_pak['pak_name']}'")
+            continue
+          client_paks_temp.append(client_pak)
+
+        # Run dependency calculation
+        with export_metrics.phase("load_map/dependencies", map_name):
+          source_list = dependency_resolver.SourceList(dependency_index)
+          for client_pak in client_paks_temp:
+            if "dep_group" in client_pak:
+              source_list.add_source(client_pak["pak_name"], client_pak["dep_group"])
+          dependency_pool = dependency_resolver.DependencyPool()
+          dependency_pool.add_bsp_dependencies(bsp_info)
+          for warning in dependency_pool.warnings:
+            map_logger.log_warning(f"dependency warning: {warning}")
+          res = dependency_resolver.resolve_dependencies(dependency_pool, source_list)
+          needed_sources = dependency_resolver.get_minimum_sources(res, source_list)
+
+          # Log dependency info
+          dependency_resolver.log_dependencies(res, needed_sources, map_logger)
+          unsatisfied = dependency_resolver.get_unsatisfied(res, False)
+          for depdendency in unsatisfied.keys():
+            unresolved_log.write(f"{map_name}: {depdendency}")
+          unresolved_count = len(unsatisfied)
+          if unresolved_count > 0:
+            map_logger.log_info(f"{unresolved_count} unresolved dependencies")
+
+        # Generate output client pak info
+        client_paks_out : list[dict] = []
+
+        for client_pak in client_paks_temp:
+          client_pk3_source : Pk3Source = pk3_sources.pk3s[client_pak["pak_name"]]
+          referenced : bool = client_pak["pak_name"] in needed_sources
+          download : bool = client_pak["download"] == "yes" or (client_pak["download"] == "auto" and referenced)
+          pure : bool = client_pak["pure"] == "yes" or (client_pak["pure"] == "auto" and referenced)
+          if not download and not pure:
+            continue
+
+          result = {
+            "pk3_name": client_pak["pak_name"],
+            "pk3_hash": client_pk3_source.pk3_hash,
+            "pk3_source_path": f"{client_pk3_source.mod_dir}/refonly/{client_pk3_source.filename}.pk3",
+            "download": download,
+          }
+
+          if "pure_sort" in client_pak:
+            result["pure_sort"] = client_pak["pure_sort"]
+
+          client_paks_out.append(result)
+
+          if download:
+            file_exporter.write_http(client_pk3_source)
+
+        info_out["client_paks"] = client_paks_out
+
+        map_records[map_name] = json.dumps(info_out)
+        info_zip.writestr("mapdb_info/%s.json" % map_name, map_records[map_name])
+      except Exception as ex:
+        map_logger.log_warning(f"Error processing map '{map_name}': {misc.error_string(ex)}")
 
     # Update logs
-    log_zip.writestr(f"maps/{map_name}.txt", '\n'.join(map_logger.get_messages(misc.Logger.TYPE_INFO)))
-    warnings_out.extend([f"MAP '{map_name}': " + line for line in map_logger.get_messages(misc.Logger.TYPE_WARNING)])
+    map_log.close()
+    if mapcfg_log != None:
+      log_zip.writestr(f"mapcfg/{map_name}.json", mapcfg_log)
 
-  for pk3 in pk3_sources.pk3s.values():
+  for pk3, pk3_mapcfg, map_configs in get_ready_pk3s():
     def register_readable_file_from_pk3(subfile):
       """ Register a bsp or aas file from pk3 by hash for future reading. """
       file_from_pk3_loader.add_resource(subfile["sha256"], FileFromPk3(pk3.full_path, subfile["python_filename"]))
 
     pk3_info = pk3.get_info()
-    pk3_mapcfg = manifest.merge_map_info(manifest.profiles.get(pk3.manifest_info.get("profile", None), {}))
-    pk3_mapcfg = manifest.merge_map_info(pk3.manifest_info.get("mapcfg", {}), pk3_mapcfg)
 
     # Write pk3 to output locations.
-    file_exporter.write_mirror_resource(pk3.res_hash, file_importer, "source pk3 - %s" % pk3.full_name)
-    file_exporter.write_server(pk3)
-    if pk3.manifest_info.get("force_http_share") == True:
-      file_exporter.write_http(pk3)
+    with export_metrics.phase("mirror_linking"):
+      file_exporter.write_mirror_resource(pk3.res_hash, file_importer, "source pk3 - %s" % pk3.full_name)
+      file_exporter.write_server(pk3)
+      if pk3.manifest_info.get("force_http_share") == True:
+        file_exporter.write_http(pk3)
 
     # Scan aas files.
     aas_table = {}
@@ -503,15 +750,16 @@ def run_export(manifest:Manifest, output_path:str, custom_paks_path:str|None=Non
 
       source_bsp_name = match_result[1].lower()
 
-      mapcfg = pk3.manifest_info.get("mapcfg_" + source_bsp_name, {})
-      versions = mapcfg.pop("versions", [{}])
-      mapcfg = manifest.merge_map_info(mapcfg, pk3_mapcfg)
-
-      for version_config in versions:
-        version_config = manifest.merge_map_info(version_config, mapcfg)
+      for version_config in map_configs.get(source_bsp_name, [pk3_mapcfg]):
         load_map(source_bsp_name, version_config, pk3)
 
+  index_logger.log_info("Indexed %i pk3s" % len(pk3_sources.pk3s), True)
+  index_logger.log_info("Initialized pk3 dependency index with %i pk3s" %
+    len(dependency_index.registered_sources))
+  index_logger.log_info("Dependency asset types: " + dependency_index.asset_counts_str())
   index_logger.log_info("Written %i maps" % len(map_duplicate_check), True)
+  index_logger.log_info("Entity files: " + entity_writer.get_stats_str(), True)
+  write_map_index(info_zip, map_records)
 
   # Check for maps renamed or skipped, but not replaced by something with the same name
   for map_name, src_pk3_name in map_unreplaced_check.items():
@@ -519,51 +767,83 @@ def run_export(manifest:Manifest, output_path:str, custom_paks_path:str|None=Non
       index_logger.log_info(f"Unreplaced skip/rename: {map_name} - {src_pk3_name}")
 
   # Add additional server resources
-  for path, entry in manifest.server_resources.items():
-    try:
-      src_path = file_importer.get_path(entry["sha256"])
-      os.link(src_path, data_out_dir.get_write_path("serverdata/" + path))
-      file_exporter.write_mirror_resource(entry["sha256"], file_importer, "server resource - %s" % path)
-    except Exception as ex:
-      index_logger.log_info(f"Failed to load server resource {path}")
+  with export_metrics.phase("server_resources"):
+    for path, entry in manifest.server_resources.items():
+      try:
+        src_path = file_importer.get_path(entry["sha256"])
+        os.link(src_path, data_out_dir.get_write_path("serverdata/" + path))
+        file_exporter.write_mirror_resource(entry["sha256"], file_importer, "server resource - %s" % path)
+      except Exception as ex:
+        index_logger.log_info(f"Failed to load server resource {path}")
 
   # Keep mirror resources from previous export so other servers with slightly older manifest
   # can still download needed files
-  if keep_old_mirror:
-    try:
-      old_mirror_dir = base_dir.get_subdir(os.path.join("data", "httpshare", "resources"))
-      if os.path.exists(old_mirror_dir.path):
-        for resource in os.listdir(old_mirror_dir.path):
-          file_exporter.write_mirror_resource_direct(
-            resource, lambda: old_mirror_dir.get_read_path(resource), "old resource")
-    except Exception as ex:
-      index_logger.log_info(f"Failed to load old mirror files: {ex}")
+  with export_metrics.phase("mirror_linking"):
+    if keep_old_mirror:
+      try:
+        old_mirror_dir = base_dir.get_subdir(os.path.join("data", "httpshare", "resources"))
+        if os.path.exists(old_mirror_dir.path):
+          for resource in os.listdir(old_mirror_dir.path):
+            file_exporter.write_mirror_resource_direct(
+              resource, lambda: old_mirror_dir.get_read_path(resource), "old resource")
+      except Exception as ex:
+        index_logger.log_info(f"Failed to load old mirror files: {ex}")
+
+  # Record cache usage
+  for pk3 in pk3_sources.pk3s.values():
+    cache_manager.mark_used("resources/%s" % pk3.res_hash)
+    cache_manager.mark_used("pk3info/%s.json" % pk3.manifest_info["sha256"])
+  for res_hash in file_exporter.mirror_written:
+    cache_manager.mark_used("resources/%s" % res_hash)
+  for res_hash in bsp_resources_written:
+    cache_manager.mark_used("pk3resource_bsp/%s.pk3" % res_hash)
+  for res_hash in aas_resources_written:
+    cache_manager.mark_used("pk3resource_aas/%s.pk3" % res_hash)
+  cache_manager.save()
 
   # Update logs
-  warnings_out.extend([line for line in index_logger.get_messages(misc.Logger.TYPE_WARNING)])
-  log_zip.writestr(f"index.txt", '\n'.join(index_logger.get_messages(misc.Logger.TYPE_INFO)))
+  index_logger.log_info("Logged %i warnings and %i unresolved dependencies" % (warnings_log.line_count,
+    unresolved_log.line_count), True)
+  index_log.copy_to_zip(log_zip, "index.txt")
   index_logger = None
-  log_zip.writestr(f"download.txt", '\n'.join(download_logger.get_messages(misc.Logger.TYPE_INFO)))
+  download_log.copy_to_zip(log_zip, "download.txt")
   download_logger = None
 
   # Write shared resources
   log_zip.writestr("mirror_resources.txt", file_exporter.get_mirror_resource_log())
 
-  log_zip.writestr("warnings.txt", '\n'.join(warnings_out))
-  log_zip.writestr("unresolved.txt", '\n'.join(unresolved_info_out))
+  warnings_log.copy_to_zip(log_zip, "warnings.txt")
+  unresolved_log.copy_to_zip(log_zip, "unresolved.txt")
 
   info_zip.close()
   entity_zip.close()
-  log_zip.close()
 
-  # Cycle output directories
+  # Clear old directory before writing metrics, so the slow part of directory cycling is
+  # included, and logs.zip is complete before it is moved into the live data directory
   data_old = base_dir.get_subdir("data_old")
-  if os.path.exists(data_old.path):
-    print("Clearing old directory...")
-    shutil.rmtree(data_old.path)
+  data_dir = base_dir.get_subdir("data")
+  with export_metrics.phase("directory_cycling"):
+    if os.path.exists(data_old.path):
+      print("Clearing old directory...")
+      shutil.rmtree(data_old.path)
+
+  # Write metrics
+  log_zip.writestr("metrics.json", json.dumps(export_metrics.export_serializable(), indent=2))
+  log_zip.close()
 
+  # Cycle output directories
   print("Cycling directories...")
-  data_dir = base_dir.get_subdir("data")
   if os.path.exists(data_dir.path):
     os.rename(data_dir.path, data_old.path)
   os.rename(data_out_dir.path, data_dir.path)
+
+  print('\n'.join(export_metrics.get_summary("load_map")))
+
+  # Remove unused cache entries
+  if cache_size_budget != None:
+    print("Collecting cache...")
+    gc_logger = misc.Logger()
+    cache_manager.collect(cache_size_budget, [data_dir.path, data_old.path], gc_logger, cache_gc_dry_run)
+    cache_manager.save()
+    with open(base_dir.get_write_path("cache_gc.txt"), "w", encoding="utf-8") as tgt:
+      tgt.write('\n'.join(gc_logger.get_messages(misc.Logger.TYPE_INFO)))
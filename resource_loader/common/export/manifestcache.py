@@ -0,0 +1,69 @@
+"""
+Caches the merged manifest and resolved map configs from a set of profile files, so exports
+with unchanged profiles don't need to parse and merge them again.
+
+The snapshot is keyed by the content hashes of the input profiles, so it is rebuilt
+automatically when any profile changes.
+"""
+
+from ..utils import misc
+from . import export
+import hashlib
+import json
+import os
+import pickle
+import sys
+
+# Increment when snapshot contents change
+format_version = 1
+
+def get_snapshot_key(profile_data:list[bytes]) -> str:
+  """ Returns key identifying a sequence of profile file contents. """
+  key_hash = hashlib.sha256(("manifest-v%i-py%i.%i\n" % (format_version, *sys.version_info[:2])).encode("utf-8"))
+  for data in profile_data:
+    key_hash.update(hashlib.sha256(data).digest())
+  return key_hash.hexdigest()
+
+def build_manifest(profile_data:list[bytes]) -> export.Manifest:
+  manifest = export.Manifest()
+  for data in profile_data:
+    manifest.import_manifest(json.loads(data))
+  manifest.resolve_all()
+  return manifest
+
+def load_manifest(profile_paths:list[str], cache_dir:misc.DirectoryHandler) -> export.Manifest:
+  """ Returns manifest for profiles, loading from snapshot in cache_dir if available.
+  Profiles are imported in order, so later profiles have precedence. """
+  profile_data : list[bytes] = []
+  for path in profile_paths:
+    with open(path, "rb") as src:
+      profile_data.append(src.read())
+  snapshot_name = "%s.pickle" % get_snapshot_key(profile_data)
+  snapshot_path = cache_dir.get_write_path(snapshot_name)
+
+  if os.path.exists(snapshot_path):
+    try:
+      with open(snapshot_path, "rb") as src:
+        snapshot = pickle.loads(src.read())
+      manifest = export.Manifest()
+      manifest.import_snapshot(snapshot)
+      print("Loaded manifest snapshot.")
+      return manifest
+    except Exception as ex:
+      print("Failed to load manifest snapshot: %s" % misc.error_string(ex))
+
+  print("Building manifest snapshot...")
+  manifest = build_manifest(profile_data)
+
+  # Write to temporary file first so an interrupted write doesn't leave a corrupt snapshot
+  temp_path = snapshot_path + ".tmp"
+  with open(temp_path, "wb") as tgt:
+    tgt.write(pickle.dumps(manifest.export_snapshot(), protocol=pickle.HIGHEST_PROTOCOL))
+  os.replace(temp_path, snapshot_path)
+
+  # Remove snapshots for previous profile versions
+  for filename in os.listdir(cache_dir.path):
+    if filename != snapshot_name:
+      os.remove(cache_dir.get_read_path(filename))
+
+  return manifest
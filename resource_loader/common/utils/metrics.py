@@ -0,0 +1,97 @@
+"""
+Records timing and counters for phases of the export process.
+"""
+
+import contextlib
+import time
+from . import profiling
+
+def read_process_io() -> tuple[int, int]:
+  """ Returns total bytes read and written by this process, or zeros if not supported. """
+  try:
+    with open("/proc/self/io", "r") as src:
+      fields = dict(line.split(": ", 1) for line in src.read().splitlines())
+    return int(fields["rchar"]), int(fields["wchar"])
+  except Exception:
+    return 0, 0
+
+class Sample():
+  """ Snapshot of process counters at a point in time. """
+  def __init__(self):
+    self.wall = time.perf_counter()
+    self.cpu = time.process_time()
+    self.bytes_read, self.bytes_written = read_process_io()
+
+class PhaseStats():
+  """ Accumulated counters for one phase. Items can be incremented by the caller to
+  record the number of things processed during the phase. """
+  def __init__(self):
+    self.calls = 0
+    self.items = 0
+    self.wall = 0.0
+    self.cpu = 0.0
+    self.bytes_read = 0
+    self.bytes_written = 0
+
+  def add(self, start:Sample, end:Sample):
+    self.calls += 1
+    self.wall += end.wall - start.wall
+    self.cpu += end.cpu - start.cpu
+    self.bytes_read += end.bytes_read - start.bytes_read
+    self.bytes_written += end.bytes_written - start.bytes_written
+
+  def export_serializable(self) -> dict:
+    return {
+      "calls": self.calls,
+      "items": self.items,
+      "wall": round(self.wall, 6),
+      "cpu": round(self.cpu, 6),
+      "bytes_read": self.bytes_read,
+      "bytes_written": self.bytes_written,
+    }
+
+class Metrics():
+  """ Collects per-phase stats for a run, with optional breakdown per map. If profiler
+  is set, phases are also passed to it for optional profiling. """
+  def __init__(self, profiler:profiling.PhaseProfiler|None=None):
+    self.phases : dict[str, PhaseStats] = {}
+    self.maps : dict[str, dict[str, PhaseStats]] = {}
+    self.profiler = profiler
+
+  @contextlib.contextmanager
+  def phase(self, name:str, map_name:str|None=None):
+    """ Context manager to record a phase. Phases with the same name are accumulated.
+    If map_name is set, stats are also recorded in the per-map table. """
+    stats = self.phases.setdefault(name, PhaseStats())
+    start = Sample()
+    try:
+      if self.profiler:
+        with self.profiler.profile(name, map_name):
+          yield stats
+      else:
+        yield stats
+    finally:
+      end = Sample()
+      stats.add(start, end)
+      if map_name != None:
+        self.maps.setdefault(map_name, {}).setdefault(name, PhaseStats()).add(start, end)
+
+  def export_serializable(self) -> dict:
+    return {
+      "phases": {name: stats.export_serializable() for name, stats in self.phases.items()},
+      "maps": {map_name: {name: stats.export_serializable() for name, stats in phases.items()}
+               for map_name, phases in self.maps.items()},
+    }
+
+  def get_summary(self, map_phase:str, slowest_count:int=10) -> list[str]:
+    """ Returns readable lines listing phase totals and the slowest maps for map_phase. """
+    lines = ["Phase times:"]
+    for name, stats in self.phases.items():
+      lines.append("  %s: %.2fs wall, %.2fs cpu, %i calls" % (name, stats.wall, stats.cpu, stats.calls))
+    map_times = [(map_name, phases[map_phase].wall) for map_name, phases in self.maps.items() if map_phase in phases]
+    map_times.sort(key=lambda x: x[1], reverse=True)
+    if map_times:
+      lines.append("Slowest maps:")
+      for map_name, wall in map_times[:slowest_count]:
+        lines.append("  %s: %.2fs" % (map_name, wall))
+    return lines
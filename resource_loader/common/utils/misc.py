@@ -5,9 +5,25 @@ Support file with misc utility functions.
 import json
 import os
 import hashlib
+import queue
+import threading
+import shutil
+import concurrent.futures
 import struct
+import sys
+import tempfile
 import traceback
+import typing
 import urllib.request
+import zipfile
+try:
+  import fcntl
+except ImportError:
+  # Not available on Windows
+  fcntl = None
+
+# fcntl.FICLONE is only defined from Python 3.12, so use the Linux ioctl number directly
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409) if fcntl and sys.platform == "linux" else None
 
 def convert_fs_path(path:str):
   # Replace slash types and skip leading slash for consistency with game filesystem.
@@ -28,12 +44,89 @@ def update_delete_null(src:dict, tgt:dict):
     else:
       tgt.pop(key, None)
 
-def file_sha256(path):
+def file_sha256(path, buffer_size=65536):
   sha256_hash = hashlib.sha256()
-  with open(path,"rb") as f:
-    for byte_block in iter(lambda: f.read(65536), b""):
-      sha256_hash.update(byte_block)
+  buffer = bytearray(buffer_size)
+  view = memoryview(buffer)
+  with open(path, "rb", buffering=0) as f:
+    while size := f.readinto(buffer):
+      sha256_hash.update(view[:size])
     return sha256_hash.hexdigest()
+
+def files_sha256(paths:list[str], buffer_size=1048576, max_workers=4) -> list[str]:
+  """ Hash multiple files in parallel. hashlib releases the GIL for large updates, so
+  threads allow reads and hashing of different files to overlap. """
+  if len(paths) <= 1:
+    return [file_sha256(path, buffer_size) for path in paths]
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    return list(executor.map(lambda path: file_sha256(path, buffer_size), paths))
+
+def reflink_or_copy(src_path:str, tgt_path:str):
+  """ Create file at tgt_path with the contents of src_path, using a reflink if supported
+  by the filesystem, and falling back to a regular copy. Hardlinks are not used, since
+  the source may be edited in place and the target must keep the original contents. """
+  if FICLONE != None:
+    try:
+      with open(src_path, "rb") as src, open(tgt_path, "wb") as tgt:
+        fcntl.ioctl(tgt.fileno(), FICLONE, src.fileno())
+      return
+    except OSError:
+      if os.path.exists(tgt_path):
+        os.remove(tgt_path)
+  shutil.copy(src_path, tgt_path)
+
+class FileHashCache():
+  """ Persistent cache of file sha256 hashes, keyed by path and stat fingerprint
+  (size, mtime_ns, inode), to avoid rehashing files that haven't changed. Only entries
+  for paths accessed since loading are saved, so removed files are dropped. """
+  def __init__(self, cache_path:str):
+    self.cache_path = cache_path
+    self.entries : dict[str, dict] = {}
+    self.used : set[str] = set()
+    self.modified = False
+    try:
+      self.entries = read_json_file(cache_path)
+    except Exception:
+      pass
+
+  @staticmethod
+  def get_fingerprint(stat:os.stat_result) -> list[int]:
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+  def get(self, path:str, stat:os.stat_result) -> str|None:
+    """ Returns cached hash if file is unchanged, None otherwise. """
+    self.used.add(os.path.abspath(path))
+    entry = self.entries.get(os.path.abspath(path))
+    if entry and entry["fingerprint"] == self.get_fingerprint(stat):
+      return entry["sha256"]
+    return None
+
+  def set(self, path:str, stat:os.stat_result, sha256:str):
+    self.used.add(os.path.abspath(path))
+    self.entries[os.path.abspath(path)] = {"fingerprint": self.get_fingerprint(stat), "sha256": sha256}
+    self.modified = True
+
+  def get_hashes(self, paths:list[str]) -> list[str]:
+    """ Returns hashes for given paths, hashing any that are not cached in parallel. """
+    stats = [os.stat(path) for path in paths]
+    results = [self.get(path, stat) for path, stat in zip(paths, stats)]
+    misses = [index for index, result in enumerate(results) if result == None]
+    for index, sha256 in zip(misses, files_sha256([paths[index] for index in misses])):
+      # Only cache if file wasn't modified while being hashed, since the hash may not
+      # match either version
+      if self.get_fingerprint(os.stat(paths[index])) == self.get_fingerprint(stats[index]):
+        self.set(paths[index], stats[index], sha256)
+      results[index] = sha256
+    return results  # type: ignore
+
+  def save(self):
+    if unused := set(self.entries) - self.used:
+      for path in unused:
+        del self.entries[path]
+      self.modified = True
+    if self.modified:
+      write_json_file(self.entries, self.cache_path)
+      self.modified = False
   
 def read_json_file(path):
   with open(path, "r", encoding="utf-8") as src:
@@ -142,42 +235,139 @@ class HashShortener():
 def error_string(ex: Exception) -> str:
   return ''.join(traceback.format_exception(None, ex, ex.__traceback__)).strip()
 
+class LogSink():
+  """ Writes log lines to a binary stream as they are logged, separated by newlines. """
+  def __init__(self, stream:typing.BinaryIO|typing.IO[bytes]):
+    self.stream = stream
+    self.line_count = 0
+    # Loggers may be shared with background threads, such as downloads
+    self.lock = threading.Lock()
+
+  def write(self, line:str):
+    with self.lock:
+      if self.line_count:
+        self.stream.write(b"\n")
+      self.stream.write(line.encode("utf-8"))
+      self.line_count += 1
+
+  def close(self):
+    self.stream.close()
+
+def zip_log_sink(zip_file:zipfile.ZipFile, name:str) -> LogSink:
+  """ Returns sink writing directly to a zip member. Other members can't be written to the
+  zip file until the sink is closed. """
+  return LogSink(zip_file.open(name, "w"))
+
+class SpoolLogSink(LogSink):
+  """ Sink writing to a temporary file, for logs that are active while other zip members
+  are written. The result is copied to the zip file by copy_to_zip. """
+  def __init__(self):
+    super().__init__(tempfile.TemporaryFile())
+
+  def copy_to_zip(self, zip_file:zipfile.ZipFile, name:str):
+    self.stream.seek(0)
+    with zip_file.open(name, "w") as tgt:
+      shutil.copyfileobj(self.stream, tgt)
+    self.close()
+
+class BackgroundZipWriter():
+  """ Writes members to zip file from a background thread, so compression and file writes
+  overlap with work on the calling thread. Members are written in submission order, so
+  output is the same as writing directly. Queue size limits the data held in memory. """
+  def __init__(self, zip_file:zipfile.ZipFile, queue_size:int=64):
+    self.zip_file = zip_file
+    self.queue : queue.Queue[tuple[str, bytes|str]|None] = queue.Queue(queue_size)
+    self.error : Exception|None = None
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def run(self):
+    while (item := self.queue.get()) != None:
+      # After an error, keep draining the queue so writestr calls don't block
+      if self.error == None:
+        try:
+          self.zip_file.writestr(*item)
+        except Exception as ex:
+          self.error = ex
+
+  def check_error(self):
+    if self.error != None:
+      raise Exception(f"Error writing zip file '{self.zip_file.filename}': {error_string(self.error)}")
+
+  def writestr(self, name:str, data:bytes|str):
+    self.check_error()
+    self.queue.put((name, data))
+
+  def close(self):
+    """ Waits for queued members to be written and closes zip file. """
+    self.queue.put(None)
+    self.thread.join()
+    self.zip_file.close()
+    self.check_error()
+
 class Logger():
-  """ Simple logging class to handle messages generated during map export. """
+  """ Simple logging class to handle messages generated during map export. Messages are
+  passed to any added sinks as they are logged. If keep_messages is set, messages are also
+  stored for get_messages. """
   TYPE_INFO = 0
   TYPE_WARNING = 1
 
-  def __init__(self, print_all=False):
+  prefixes = {
+    TYPE_INFO: "INFO: ",
+    TYPE_WARNING: "WARNING: "
+  }
+
+  def __init__(self, print_all=False, keep_messages=True):
     self.messages : list[tuple[int, str]] = []
     self.print_all = print_all
+    self.keep_messages = keep_messages
+    self.counts = {Logger.TYPE_INFO: 0, Logger.TYPE_WARNING: 0}
+    self.sinks : list[tuple[LogSink, int, str]] = []
+    # Loggers may be shared with background threads, such as downloads
+    self.lock = threading.Lock()
+
+  def add_sink(self, sink:LogSink, min_level:int, prefix:str=""):
+    """ Writes messages at min_level and above to sink, in get_messages format preceded by prefix. """
+    self.sinks.append((sink, min_level, prefix))
+
+  def add_message(self, level:int, msg:str):
+    with self.lock:
+      self.counts[level] += 1
+      if self.keep_messages:
+        self.messages.append((level, msg))
+    for sink, min_level, prefix in self.sinks:
+      if level >= min_level:
+        sink.write(prefix + Logger.prefixes[level] + msg)
 
   def log_info(self, msg:str, force_print=False):
-    self.messages.append((Logger.TYPE_INFO, msg))
+    self.add_message(Logger.TYPE_INFO, msg)
     if self.print_all or force_print:
       print("INFO: " + msg)
 
   def log_warning(self, msg:str):
-    self.messages.append((Logger.TYPE_WARNING, msg))
+    self.add_message(Logger.TYPE_WARNING, msg)
     print("WARNING: " + msg)
 
   def get_messages(self, min_level:int) -> list[str]:
-    prefixes = {
-      Logger.TYPE_INFO: "INFO: ",
-      Logger.TYPE_WARNING: "WARNING: "
-    }
-    return [prefixes[entry[0]] + entry[1] for entry in self.messages if entry[0] >= min_level]
+    """ Returns stored messages. Only available if keep_messages is set. """
+    assert self.keep_messages
+    return [Logger.prefixes[entry[0]] + entry[1] for entry in self.messages if entry[0] >= min_level]
 
 def download_address(address:str) -> bytes:
   with urllib.request.urlopen(address, timeout=60) as req:
     return req.read()
 
 class ResourceDownloader():
+  """ Downloads resources by hash. Safe to call from multiple threads. """
   def __init__(self, urls, logger):
     self.urls : list[str] = list(urls)
     self.logger : Logger = logger
+    self.lock = threading.Lock()
 
   def download(self, res_hash:str, target_path:str):
-    for url_base in self.urls:
+    with self.lock:
+      urls = self.urls
+    for url_base in urls:
       url = url_base.format(hash=res_hash)
       try:
         data = download_address(url)
@@ -191,11 +381,21 @@ class ResourceDownloader():
         self.logger.log_warning(f"incorrect hash for '{url}'")
         continue
 
-      with open(target_path, "wb") as tgt:
-        tgt.write(data)
-      
+      # Write to temporary file first, so other threads checking for the target path
+      # never see a partially written file
+      temp_path = target_path + ".tmp"
+      try:
+        with open(temp_path, "wb") as tgt:
+          tgt.write(data)
+        os.replace(temp_path, target_path)
+      except OSError:
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+        raise
+
       # Move url of successful query to top of list.
-      self.urls = [url_base, *[other for other in self.urls if other != url_base]]
+      with self.lock:
+        self.urls = [url_base, *[other for other in self.urls if other != url_base]]
       return True
 
     self.logger.log_warning(f"failed to download {res_hash} from any source")
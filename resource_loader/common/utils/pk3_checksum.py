@@ -0,0 +1,180 @@
+"""
+Computes the 32-bit pk3 checksum used by the game to identify pk3s, which is the xor of the
+md4 state words over the little-endian CRC32 list of the pk3's files.
+
+Uses OpenSSL md4 through hashlib when available. Many OpenSSL 3 builds only provide md4 in
+the legacy provider, in which case an unrolled pure Python implementation is used instead.
+"""
+
+from ..libs import md4
+import collections.abc
+import hashlib
+import random
+import struct
+
+def _openssl_md4_available() -> bool:
+  try:
+    # Check against a known result in case the platform returns something unexpected
+    return hashlib.new("md4", b"BEES").hexdigest() == "501af1ef4b68495b5b7e37b15b4cda68"
+  except ValueError:
+    return False
+
+openssl_md4_available = _openssl_md4_available()
+
+def md4_pad(data:bytes) -> bytes:
+  """ Returns data with md4 padding and length appended, making it a multiple of 64 bytes. """
+  return data + b"\x80" + bytes(-(len(data) + 9) % 64) + struct.pack("<Q", len(data) * 8)
+
+def md4_words_python(data:bytes) -> tuple[int, int, int, int]:
+  """ Returns the four md4 state words for data, processing all blocks in a single call
+  with the round schedule unrolled into local variables. """
+  padded = md4_pad(data)
+  words = struct.unpack("<%iI" % (len(padded) // 4), padded)
+  h0, h1, h2, h3 = 0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476
+  for offset in range(0, len(words), 16):
+    x0, x1, x2, x3, x4, x5, x6, x7, x8, x9, x10, x11, x12, x13, x14, x15 = words[offset:offset + 16]
+    a, b, c, d = h0, h1, h2, h3
+    # Round 1
+    t = (a + (d ^ (b & (c ^ d))) + x0) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + (c ^ (a & (b ^ c))) + x1) & 0xFFFFFFFF
+    d = ((t << 7) | (t >> 25)) & 0xFFFFFFFF
+    t = (c + (b ^ (d & (a ^ b))) + x2) & 0xFFFFFFFF
+    c = ((t << 11) | (t >> 21)) & 0xFFFFFFFF
+    t = (b + (a ^ (c & (d ^ a))) + x3) & 0xFFFFFFFF
+    b = ((t << 19) | (t >> 13)) & 0xFFFFFFFF
+    t = (a + (d ^ (b & (c ^ d))) + x4) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + (c ^ (a & (b ^ c))) + x5) & 0xFFFFFFFF
+    d = ((t << 7) | (t >> 25)) & 0xFFFFFFFF
+    t = (c + (b ^ (d & (a ^ b))) + x6) & 0xFFFFFFFF
+    c = ((t << 11) | (t >> 21)) & 0xFFFFFFFF
+    t = (b + (a ^ (c & (d ^ a))) + x7) & 0xFFFFFFFF
+    b = ((t << 19) | (t >> 13)) & 0xFFFFFFFF
+    t = (a + (d ^ (b & (c ^ d))) + x8) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + (c ^ (a & (b ^ c))) + x9) & 0xFFFFFFFF
+    d = ((t << 7) | (t >> 25)) & 0xFFFFFFFF
+    t = (c + (b ^ (d & (a ^ b))) + x10) & 0xFFFFFFFF
+    c = ((t << 11) | (t >> 21)) & 0xFFFFFFFF
+    t = (b + (a ^ (c & (d ^ a))) + x11) & 0xFFFFFFFF
+    b = ((t << 19) | (t >> 13)) & 0xFFFFFFFF
+    t = (a + (d ^ (b & (c ^ d))) + x12) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + (c ^ (a & (b ^ c))) + x13) & 0xFFFFFFFF
+    d = ((t << 7) | (t >> 25)) & 0xFFFFFFFF
+    t = (c + (b ^ (d & (a ^ b))) + x14) & 0xFFFFFFFF
+    c = ((t << 11) | (t >> 21)) & 0xFFFFFFFF
+    t = (b + (a ^ (c & (d ^ a))) + x15) & 0xFFFFFFFF
+    b = ((t << 19) | (t >> 13)) & 0xFFFFFFFF
+    # Round 2
+    t = (a + ((b & c) | (d & (b | c))) + x0 + 0x5A827999) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + ((a & b) | (c & (a | b))) + x4 + 0x5A827999) & 0xFFFFFFFF
+    d = ((t << 5) | (t >> 27)) & 0xFFFFFFFF
+    t = (c + ((d & a) | (b & (d | a))) + x8 + 0x5A827999) & 0xFFFFFFFF
+    c = ((t << 9) | (t >> 23)) & 0xFFFFFFFF
+    t = (b + ((c & d) | (a & (c | d))) + x12 + 0x5A827999) & 0xFFFFFFFF
+    b = ((t << 13) | (t >> 19)) & 0xFFFFFFFF
+    t = (a + ((b & c) | (d & (b | c))) + x1 + 0x5A827999) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + ((a & b) | (c & (a | b))) + x5 + 0x5A827999) & 0xFFFFFFFF
+    d = ((t << 5) | (t >> 27)) & 0xFFFFFFFF
+    t = (c + ((d & a) | (b & (d | a))) + x9 + 0x5A827999) & 0xFFFFFFFF
+    c = ((t << 9) | (t >> 23)) & 0xFFFFFFFF
+    t = (b + ((c & d) | (a & (c | d))) + x13 + 0x5A827999) & 0xFFFFFFFF
+    b = ((t << 13) | (t >> 19)) & 0xFFFFFFFF
+    t = (a + ((b & c) | (d & (b | c))) + x2 + 0x5A827999) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + ((a & b) | (c & (a | b))) + x6 + 0x5A827999) & 0xFFFFFFFF
+    d = ((t << 5) | (t >> 27)) & 0xFFFFFFFF
+    t = (c + ((d & a) | (b & (d | a))) + x10 + 0x5A827999) & 0xFFFFFFFF
+    c = ((t << 9) | (t >> 23)) & 0xFFFFFFFF
+    t = (b + ((c & d) | (a & (c | d))) + x14 + 0x5A827999) & 0xFFFFFFFF
+    b = ((t << 13) | (t >> 19)) & 0xFFFFFFFF
+    t = (a + ((b & c) | (d & (b | c))) + x3 + 0x5A827999) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + ((a & b) | (c & (a | b))) + x7 + 0x5A827999) & 0xFFFFFFFF
+    d = ((t << 5) | (t >> 27)) & 0xFFFFFFFF
+    t = (c + ((d & a) | (b & (d | a))) + x11 + 0x5A827999) & 0xFFFFFFFF
+    c = ((t << 9) | (t >> 23)) & 0xFFFFFFFF
+    t = (b + ((c & d) | (a & (c | d))) + x15 + 0x5A827999) & 0xFFFFFFFF
+    b = ((t << 13) | (t >> 19)) & 0xFFFFFFFF
+    # Round 3
+    t = (a + (b ^ c ^ d) + x0 + 0x6ED9EBA1) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + (a ^ b ^ c) + x8 + 0x6ED9EBA1) & 0xFFFFFFFF
+    d = ((t << 9) | (t >> 23)) & 0xFFFFFFFF
+    t = (c + (d ^ a ^ b) + x4 + 0x6ED9EBA1) & 0xFFFFFFFF
+    c = ((t << 11) | (t >> 21)) & 0xFFFFFFFF
+    t = (b + (c ^ d ^ a) + x12 + 0x6ED9EBA1) & 0xFFFFFFFF
+    b = ((t << 15) | (t >> 17)) & 0xFFFFFFFF
+    t = (a + (b ^ c ^ d) + x2 + 0x6ED9EBA1) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + (a ^ b ^ c) + x10 + 0x6ED9EBA1) & 0xFFFFFFFF
+    d = ((t << 9) | (t >> 23)) & 0xFFFFFFFF
+    t = (c + (d ^ a ^ b) + x6 + 0x6ED9EBA1) & 0xFFFFFFFF
+    c = ((t << 11) | (t >> 21)) & 0xFFFFFFFF
+    t = (b + (c ^ d ^ a) + x14 + 0x6ED9EBA1) & 0xFFFFFFFF
+    b = ((t << 15) | (t >> 17)) & 0xFFFFFFFF
+    t = (a + (b ^ c ^ d) + x1 + 0x6ED9EBA1) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + (a ^ b ^ c) + x9 + 0x6ED9EBA1) & 0xFFFFFFFF
+    d = ((t << 9) | (t >> 23)) & 0xFFFFFFFF
+    t = (c + (d ^ a ^ b) + x5 + 0x6ED9EBA1) & 0xFFFFFFFF
+    c = ((t << 11) | (t >> 21)) & 0xFFFFFFFF
+    t = (b + (c ^ d ^ a) + x13 + 0x6ED9EBA1) & 0xFFFFFFFF
+    b = ((t << 15) | (t >> 17)) & 0xFFFFFFFF
+    t = (a + (b ^ c ^ d) + x3 + 0x6ED9EBA1) & 0xFFFFFFFF
+    a = ((t << 3) | (t >> 29)) & 0xFFFFFFFF
+    t = (d + (a ^ b ^ c) + x11 + 0x6ED9EBA1) & 0xFFFFFFFF
+    d = ((t << 9) | (t >> 23)) & 0xFFFFFFFF
+    t = (c + (d ^ a ^ b) + x7 + 0x6ED9EBA1) & 0xFFFFFFFF
+    c = ((t << 11) | (t >> 21)) & 0xFFFFFFFF
+    t = (b + (c ^ d ^ a) + x15 + 0x6ED9EBA1) & 0xFFFFFFFF
+    b = ((t << 15) | (t >> 17)) & 0xFFFFFFFF
+
+    h0 = (h0 + a) & 0xFFFFFFFF
+    h1 = (h1 + b) & 0xFFFFFFFF
+    h2 = (h2 + c) & 0xFFFFFFFF
+    h3 = (h3 + d) & 0xFFFFFFFF
+  return h0, h1, h2, h3
+
+def md4_words_openssl(data:bytes) -> tuple[int, int, int, int]:
+  return struct.unpack("<4I", hashlib.new("md4", data).digest())  # type: ignore
+
+md4_words = md4_words_openssl if openssl_md4_available else md4_words_python
+
+def crc_list_hash(crc_list:collections.abc.Sequence[int]) -> int:
+  """ Returns signed 32-bit pk3 checksum for list of file CRCs. """
+  h0, h1, h2, h3 = md4_words(struct.pack("<%iL" % len(crc_list), *crc_list))
+  # Convert to signed integer to be more consistent with game formatting
+  result = h0 ^ h1 ^ h2 ^ h3
+  return result - 0x100000000 if result & 0x80000000 else result
+
+def crc_list_hashes(crc_lists:collections.abc.Iterable[collections.abc.Sequence[int]]) -> list[int]:
+  """ Returns pk3 checksums for multiple CRC lists. """
+  return [crc_list_hash(crc_list) for crc_list in crc_lists]
+
+def verify(count:int=500, seed:int=0) -> list[str]:
+  """ Compares md4 implementations against the reference libs/md4 implementation on random
+  inputs covering single and multi-block lengths. Returns list of mismatches. """
+  rng = random.Random(seed)
+  implementations = {"python": md4_words_python}
+  if openssl_md4_available:
+    implementations["openssl"] = md4_words_openssl
+  errors : list[str] = []
+  for index in range(count):
+    data = rng.randbytes(rng.choice((index % 130, rng.randrange(4096))))
+    reference = md4.MD4(data)
+    expected = tuple(reference.h)
+    for name, func in implementations.items():
+      if func(data) != expected:
+        errors.append("%s md4 mismatch for %i byte input" % (name, len(data)))
+    crcs = [rng.getrandbits(32) for _ in range(rng.randrange(200))]
+    reference = md4.MD4(struct.pack("<%iL" % len(crcs), *crcs))
+    checksum = reference.h[0] ^ reference.h[1] ^ reference.h[2] ^ reference.h[3]
+    expected_hash = struct.unpack("<l", struct.pack("<L", checksum))[0]
+    if crc_list_hash(crcs) != expected_hash or crc_list_hashes([crcs]) != [expected_hash]:
+      errors.append("pk3 checksum mismatch for %i crc list" % len(crcs))
+  return errors
@@ -8,7 +8,7 @@ import zipfile
 import hashlib
 import collections.abc
 from . import game_parse
-from ..libs import md4
+from . import pk3_checksum
 
 bsp_file_reg = re.compile(r"maps[/\\]([^/\\]+)\.bsp", flags=re.IGNORECASE)
 aas_file_reg = re.compile(r"maps[/\\]([^/\\]+)\.aas", flags=re.IGNORECASE)
@@ -154,11 +154,7 @@ def get_pk3_subfile_info(file_info, source_zip:zipfile.ZipFile):
 
 def get_pk3_hash(crcList : collections.abc.Sequence[int]) -> int:
   """ Calculates 32-bit hash used to identify pk3 in game. """
-  data = struct.pack('<%iL' % len(crcList), *crcList)
-  md4result = md4.MD4(data)
-  block_checksum = md4result.h[0] ^ md4result.h[1] ^ md4result.h[2] ^ md4result.h[3]
-  # Convert to signed integer to be more consistent with game formatting
-  return struct.unpack('<l', struct.pack('<L', block_checksum))[0]
+  return pk3_checksum.crc_list_hash(crcList)
 
 def get_pk3_info(path : str) -> dict:
   """ Retrieves info for pk3 at specified path. Returns fields:
@@ -0,0 +1,87 @@
+"""
+Optional cProfile and tracemalloc instrumentation for selected export phases or maps.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import tracemalloc
+try:
+  import resource
+except ImportError:
+  # Not available on Windows
+  resource = None
+
+def get_peak_rss() -> int|None:
+  """ Returns peak resident set size of this process in bytes, if supported. """
+  if not resource:
+    return None
+  # ru_maxrss is in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class PhaseProfiler():
+  """ Profiles phases recorded through metrics.Metrics. A phase is profiled if its name
+  is in phases, or if it is associated with a map in maps. Nested phases are included in
+  the outermost profiled phase. Peak RSS is sampled at the end of each profiled phase and
+  at the end of the run. If trace_memory is set, tracemalloc runs only during profiled
+  phases, so other phases are not slowed. Results are written to output_dir by finish(). """
+  def __init__(self, output_dir:str, phases:set[str], maps:set[str], trace_memory:bool=False, top_count:int=25):
+    self.output_dir = output_dir
+    self.phases = phases
+    self.maps = maps
+    self.trace_memory = trace_memory
+    self.top_count = top_count
+    self.profiles : dict[str, cProfile.Profile] = {}
+    self.allocations : list[str] = []
+    self.rss_samples : list[dict] = []
+    self.active = False
+
+  def get_key(self, name:str, map_name:str|None) -> str|None:
+    """ Returns name to store profile under, or None if phase is not selected. """
+    if map_name != None and map_name in self.maps:
+      return "%s__%s" % (name.replace("/", "_"), map_name)
+    if name in self.phases:
+      return name.replace("/", "_")
+    return None
+
+  @contextlib.contextmanager
+  def profile(self, name:str, map_name:str|None):
+    key = None if self.active else self.get_key(name, map_name)
+    if key == None:
+      yield
+    else:
+      profile = self.profiles.setdefault(key, cProfile.Profile())
+      snapshot = None
+      if self.trace_memory:
+        tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot()
+      self.active = True
+      profile.enable()
+      try:
+        yield
+      finally:
+        profile.disable()
+        self.active = False
+        if snapshot:
+          self.add_allocations(key, snapshot)
+          tracemalloc.stop()
+        self.rss_samples.append({"phase": name, "map": map_name, "peak_rss": get_peak_rss()})
+
+  def add_allocations(self, key:str, start_snapshot:tracemalloc.Snapshot):
+    end_snapshot = tracemalloc.take_snapshot()
+    stats = end_snapshot.compare_to(start_snapshot, "lineno")
+    self.allocations.append("%s:" % key)
+    self.allocations.extend("  %s" % stat for stat in stats[:self.top_count])
+    self.allocations.append("")
+
+  def finish(self):
+    self.rss_samples.append({"phase": None, "map": None, "peak_rss": get_peak_rss()})
+    os.makedirs(self.output_dir, exist_ok=True)
+    for key, profile in self.profiles.items():
+      profile.dump_stats(os.path.join(self.output_dir, "%s.pstats" % key))
+    if self.trace_memory:
+      with open(os.path.join(self.output_dir, "allocations.txt"), "w", encoding="utf-8") as tgt:
+        tgt.write('\n'.join(self.allocations))
+    with open(os.path.join(self.output_dir, "rss_samples.json"), "w", encoding="utf-8") as tgt:
+      json.dump(self.rss_samples, tgt, indent=2)
@@ -0,0 +1,53 @@
+"""
+Runs resource loader micro-benchmarks on synthetic data and compares against a baseline.
+"""
+
+from common.benchmark import microbench
+from common.utils import misc
+from common.utils import pk3_checksum
+import argparse
+import os
+import sys
+script_directory = os.path.dirname(os.path.abspath(__file__))
+
+default_baseline_path = os.path.join(script_directory, "output", "benchmark_baseline.json")
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Run resource loader micro-benchmarks.")
+  parser.add_argument("names", nargs="*", help="benchmarks to run (default all)")
+  parser.add_argument("--repeat", type=int, default=5, help="number of timing repeats per benchmark")
+  parser.add_argument("--output", help="write results to json file")
+  parser.add_argument("--baseline", default=default_baseline_path, help="baseline json file to compare against")
+  parser.add_argument("--save-baseline", action="store_true", help="write results as new baseline")
+  parser.add_argument("--threshold", type=float, default=0.15,
+    help="fraction slower than baseline that counts as a regression")
+  return parser.parse_args()
+
+def process():
+  args = parse_args()
+
+  # Benchmark results are meaningless if the fast checksum doesn't match the reference
+  checksum_errors = pk3_checksum.verify()
+  for error in checksum_errors:
+    print("CHECKSUM ERROR: " + error)
+  if checksum_errors:
+    sys.exit(1)
+
+  results = microbench.run_benchmarks(args.names, args.repeat)
+
+  if args.output:
+    misc.write_json_file(results, args.output)
+
+  if args.save_baseline:
+    os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+    misc.write_json_file(results, args.baseline)
+    print("Saved baseline to '%s'" % args.baseline)
+  elif os.path.exists(args.baseline):
+    regressions = microbench.compare_results(results, misc.read_json_file(args.baseline), args.threshold)
+    for regression in regressions:
+      print("REGRESSION: " + regression)
+    if regressions:
+      sys.exit(1)
+    print("No regressions against baseline.")
+
+process()
@@ -3,7 +3,10 @@ Generates map resources for server to output path set below.
 """
 
 from common.export import export
+from common.export import manifestcache
 from common.utils import misc
+from common.utils import profiling
+import argparse
 import os
 import sys
 script_directory = os.path.dirname(os.path.abspath(__file__))
@@ -13,14 +16,51 @@ output_directory = os.path.join(script_directory, "output")
 
 custom_paks_directory = os.path.join(script_directory, "custom_paks")
 
+def parse_args():
+  parser = argparse.ArgumentParser(description="Generate map resources for server.")
+  parser.add_argument("--cache-budget-gb", type=float, default=None,
+    help="remove least recently used cache entries not needed by current or previous export "
+    "until cache is within this size")
+  parser.add_argument("--cache-gc-dry-run", action="store_true",
+    help="report cache entries that would be removed without deleting them (all unused "
+    "entries if no budget is set)")
+  parser.add_argument("--profile-phase", action="append", default=[], metavar="PHASE",
+    help="profile export phase with cProfile, e.g. 'pk3_load' or 'load_map/dependencies' (repeatable)")
+  parser.add_argument("--profile-map", action="append", default=[], metavar="MAP",
+    help="profile processing of map with cProfile (repeatable)")
+  parser.add_argument("--trace-memory", action="store_true",
+    help="record top allocation sites for profiled phases with tracemalloc")
+  args = parser.parse_args()
+  if args.trace_memory and not (args.profile_phase or args.profile_map):
+    parser.error("--trace-memory requires --profile-phase or --profile-map")
+  return args
+
 def process():
+  args = parse_args()
+
   # Load manifest
-  manifest = export.Manifest()
-  manifest.import_manifest(misc.read_json_file(f"{script_directory}/profiles/base.json"))
-  manifest.import_manifest(misc.read_json_file(f"{script_directory}/profiles/efmaps.json"))
-  manifest.import_manifest(misc.read_json_file(f"{script_directory}/profiles/mod_resources.json"))
-  manifest.import_manifest(misc.read_json_file(f"{script_directory}/profiles/engine_binaries.json"))
+  manifest = manifestcache.load_manifest([
+    f"{script_directory}/profiles/base.json",
+    f"{script_directory}/profiles/efmaps.json",
+    f"{script_directory}/profiles/mod_resources.json",
+    f"{script_directory}/profiles/engine_binaries.json",
+  ], misc.DirectoryHandler(os.path.join(output_directory, "cache", "manifest")))
+
+  cache_size_budget = None if args.cache_budget_gb == None else int(args.cache_budget_gb * 1024**3)
+  if args.cache_gc_dry_run and cache_size_budget == None:
+    # Report all unused entries
+    cache_size_budget = 0
+  profiler = None
+  if args.profile_phase or args.profile_map:
+    profiler = profiling.PhaseProfiler(os.path.join(output_directory, "profile"),
+      set(args.profile_phase), set(args.profile_map), args.trace_memory)
 
-  export.run_export(manifest, output_directory, custom_paks_directory)
+  try:
+    export.run_export(manifest, output_directory, custom_paks_directory,
+      cache_size_budget=cache_size_budget, cache_gc_dry_run=args.cache_gc_dry_run, profiler=profiler)
+  finally:
+    # Write profile even if export failed
+    if profiler:
+      profiler.finish()
 
 process()
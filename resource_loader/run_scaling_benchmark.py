@@ -0,0 +1,44 @@
+"""
+Runs end-to-end export on synthetic manifests of increasing size and records phase times
+and peak memory usage for cold and warm runs.
+"""
+
+from common.benchmark import scaling
+from common.utils import misc
+import argparse
+import os
+script_directory = os.path.dirname(os.path.abspath(__file__))
+
+default_work_directory = os.path.join(script_directory, "output", "scaling_benchmark")
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Run export scaling benchmark on synthetic pk3s.")
+  parser.add_argument("--counts", default="10,50,100,500,1000,5000",
+    help="comma separated list of pk3 counts to run")
+  parser.add_argument("--maps-per-pk3", type=int, default=2)
+  parser.add_argument("--shaders-per-pk3", type=int, default=100)
+  parser.add_argument("--textures-per-pk3", type=int, default=50)
+  parser.add_argument("--overlap", type=float, default=0.25,
+    help="fraction of each pk3's shaders and textures also defined by the next pk3")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--work-dir", default=default_work_directory,
+    help="directory for generated pk3s, export output and logs")
+  parser.add_argument("--output", help="results json file (default results.json in work directory)")
+  parser.add_argument("--keep-output", action="store_true", help="don't delete export output after each run")
+  return parser.parse_args()
+
+def process():
+  args = parse_args()
+  config = scaling.PakSetConfig(args.maps_per_pk3, args.shaders_per_pk3, args.textures_per_pk3,
+                                args.overlap, args.seed)
+  pk3_counts = [int(count) for count in args.counts.split(",")]
+  results = scaling.run_scaling(args.work_dir, pk3_counts, config, args.keep_output)
+
+  output_path = args.output or os.path.join(args.work_dir, "results.json")
+  misc.write_json_file({"config": vars(config), "results": results}, output_path)
+  print('\n'.join(scaling.get_summary(results)))
+  print("Results written to '%s'" % output_path)
+
+# Guard is needed since export runs in spawned processes, which import this module
+if __name__ == "__main__":
+  process()
@@ -0,0 +1,195 @@
+"""
+Detects changes to server config.json files. Files are only parsed again when their
+stat info changes, and on Linux inotify is used so changes are picked up immediately
+without polling. Other platforms fall back to periodically checking stat info.
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import json
+import os
+import struct
+
+CONFIG_FILENAME = "config.json"
+
+# Interval to check for changes when inotify is not available
+POLL_INTERVAL = 1
+
+# Interval for full check when inotify is active, in case any events were missed
+RESCAN_INTERVAL = 60
+
+# Delay after an event before checking, so multiple events from one edit are combined
+EVENT_DELAY = 0.05
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+DIRECTORY_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF
+# Server directories also hold log files written by the manager, so only events for
+# completed writes and renames are watched, rather than every individual write
+FILE_EVENTS = IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct("iIII")
+
+def get_stat_key(stat:os.stat_result) -> tuple[int, int, int]:
+  return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+class ConfigCache():
+  """ Parsed config.json for each server directory, reused while stat info is unchanged. """
+  def __init__(self, directory:str):
+    self.directory = directory
+    # server name => (stat key, config)
+    self.entries : dict[str, tuple[tuple[int, int, int]|None, dict]] = {}
+
+  def read_config(self, server_name:str) -> dict:
+    config_path = os.path.join(self.directory, server_name, CONFIG_FILENAME)
+    try:
+      stat_key = get_stat_key(os.stat(config_path))
+    except Exception as ex:
+      return {"error": str(ex)}
+    if (entry := self.entries.get(server_name)) and entry[0] == stat_key:
+      return entry[1]
+    try:
+      with open(config_path, "r", encoding="utf-8") as src:
+        config = json.load(src)
+    except Exception as ex:
+      config = {"error": str(ex)}
+    self.entries[server_name] = (stat_key, config)
+    return config
+
+  def read_configs(self) -> dict[str, dict]:
+    """ Returns server name => config. Server names are subdirectories of the directory. """
+    server_names = [name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name))]
+    for server_name in list(self.entries):
+      if not server_name in server_names:
+        self.entries.pop(server_name)
+    return {server_name: self.read_config(server_name) for server_name in server_names}
+
+class Inotify():
+  """ Minimal inotify interface using libc through ctypes. """
+  def __init__(self):
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self.libc.inotify_init1.argtypes = [ctypes.c_int]
+    self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+  def add_watch(self, path:str, mask:int) -> int:
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+    return wd
+
+  def read_events(self) -> list[tuple[int, int, str]]:
+    """ Returns (wd, mask, name) for all pending events. """
+    events : list[tuple[int, int, str]] = []
+    while True:
+      try:
+        data = os.read(self.fd, 65536)
+      except BlockingIOError:
+        return events
+      position = 0
+      while position + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, position)
+        position += EVENT_HEADER.size
+        name = os.fsdecode(data[position:position + length].rstrip(b"\0"))
+        position += length
+        events.append((wd, mask, name))
+
+  def close(self):
+    os.close(self.fd)
+
+class ConfigWatcher():
+  """ Waits for changes to server configs. Call wait() to block until something may
+  have changed, then read updated configs from the cache. """
+  def __init__(self, directory:str):
+    self.directory = directory
+    self.cache = ConfigCache(directory)
+    self.inotify : Inotify|None = None
+    # watch descriptor => server name, or None for the servers directory
+    self.watches : dict[int, str|None] = {}
+    self.watched_servers : set[str] = set()
+    self.changed = asyncio.Event()
+    self.inotify_error : str|None = None
+    try:
+      self.inotify = Inotify()
+      self.watches[self.inotify.add_watch(directory, DIRECTORY_EVENTS | IN_ONLYDIR)] = None
+      asyncio.get_running_loop().add_reader(self.inotify.fd, self.handle_events)
+    except Exception as ex:
+      self.close()
+      self.inotify_error = f"{type(ex).__name__} ({ex})"
+    self.update_watches()
+
+  def is_event_driven(self) -> bool:
+    return self.inotify != None
+
+  def update_watches(self):
+    """ Adds watches for any new server directories. Watches for deleted directories are
+    removed by the kernel. """
+    if not self.inotify:
+      return
+    try:
+      server_names = {name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name))}
+    except OSError:
+      return
+    self.watched_servers &= server_names
+    for server_name in server_names - self.watched_servers:
+      try:
+        self.watches[self.inotify.add_watch(os.path.join(self.directory, server_name), FILE_EVENTS | IN_ONLYDIR)] = \
+          server_name
+        self.watched_servers.add(server_name)
+      except OSError:
+        pass
+
+  def handle_events(self):
+    for wd, mask, name in self.inotify.read_events():
+      if mask & IN_Q_OVERFLOW:
+        self.changed.set()
+      elif mask & IN_IGNORED:
+        # Watch removed due to directory being deleted
+        if server_name := self.watches.pop(wd, None):
+          self.watched_servers.discard(server_name)
+      elif wd in self.watches and self.watches[wd] == None:
+        # Server directory added, removed, or renamed, or servers directory itself moved
+        if mask & IN_ISDIR or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+          self.changed.set()
+      elif name == CONFIG_FILENAME:
+        # Force parse even if stat info is unchanged, since an edit within one timestamp
+        # tick that keeps the same size isn't visible in the stat key
+        if server_name := self.watches.get(wd):
+          self.cache.entries.pop(server_name, None)
+        self.changed.set()
+
+  async def wait(self):
+    if not self.inotify:
+      await asyncio.sleep(POLL_INTERVAL)
+      return
+    try:
+      await asyncio.wait_for(self.changed.wait(), timeout=RESCAN_INTERVAL)
+      await asyncio.sleep(EVENT_DELAY)
+    except asyncio.TimeoutError:
+      pass
+    self.changed.clear()
+    self.update_watches()
+
+  def close(self):
+    if self.inotify:
+      try:
+        asyncio.get_running_loop().remove_reader(self.inotify.fd)
+      except Exception:
+        pass
+      self.inotify.close()
+      self.inotify = None
@@ -0,0 +1,120 @@
+"""
+Captures server console output. Output is read continuously as it arrives so the
+server never blocks on a full pipe. Recent lines are kept in memory for crash reports,
+and lines are written to a console log subject to a rate limit, so a server flooding
+its console can't flood the disk.
+"""
+
+import asyncio
+import codecs
+import collections
+import os
+import subprocess
+import time
+import typing
+import managerlog
+
+# Number of recent lines kept in memory
+BUFFER_LINES = 1000
+
+# Console log rate limit in bytes per second, and maximum burst size
+LOG_RATE = 16 * 1024
+LOG_BURST = 256 * 1024
+
+# Lines longer than this are split
+MAX_LINE_LENGTH = 4096
+
+READ_SIZE = 65536
+
+# Requested pipe buffer size on Linux, so output bursts can be written without waiting
+# for the manager to read them. Kept moderate since pipe buffers count toward the user's
+# fs.pipe-user-pages-soft limit (64 MiB by default), and past that new pipes get 2 pages.
+PIPE_SIZE = 256 * 1024
+F_SETPIPE_SZ = 1031
+
+class ConsoleCapture():
+  def __init__(self, log_path:str, log_writer:managerlog.LogWriter):
+    self.log_path = log_path
+    self.log_writer = log_writer
+    self.lines : collections.deque[str] = collections.deque(maxlen=BUFFER_LINES)
+    self.partial = ""
+    # Decoder keeps incomplete multibyte characters between reads
+    self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    self.log_allowance = float(LOG_BURST)
+    self.log_time = time.monotonic()
+    self.suppressed = 0
+
+  def write_log(self, line:str):
+    now = time.monotonic()
+    self.log_allowance = min(LOG_BURST, self.log_allowance + (now - self.log_time) * LOG_RATE)
+    self.log_time = now
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+    if self.log_allowance < len(line):
+      self.suppressed += 1
+      return
+    if self.suppressed:
+      self.log_writer.write(self.log_path, f"{timestamp} [{self.suppressed} lines not logged due to rate limit]\n")
+      self.suppressed = 0
+    self.log_allowance -= len(line)
+    self.log_writer.write(self.log_path, f"{timestamp} {line}\n")
+
+  def add_line(self, line:str):
+    self.lines.append(line)
+    self.write_log(line)
+
+  def add_data(self, data:bytes, final:bool=False):
+    lines = (self.partial + self.decoder.decode(data, final)).replace("\r", "").split("\n")
+    self.partial = lines.pop()
+    if len(self.partial) > MAX_LINE_LENGTH:
+      lines.append(self.partial)
+      self.partial = ""
+    for line in lines:
+      for index in range(0, max(len(line), 1), MAX_LINE_LENGTH):
+        self.add_line(line[index:index + MAX_LINE_LENGTH])
+
+  async def read_stream(self, stream:asyncio.StreamReader):
+    """ Reads from stream until end of file. Call for each new server process. """
+    self.add_line("[process started]")
+    self.decoder.reset()
+    try:
+      while data := await stream.read(READ_SIZE):
+        self.add_data(data)
+    finally:
+      self.add_data(b"", True)
+      if self.partial:
+        self.add_line(self.partial)
+        self.partial = ""
+
+  def get_lines(self, count:int) -> list[str]:
+    """ Returns up to count most recent lines. """
+    return list(self.lines)[-count:] if count > 0 else []
+
+async def start_process(args:list[str], cwd:str, capture:ConsoleCapture,
+                        log_error:typing.Callable[[str], None]) -> tuple[asyncio.subprocess.Process, asyncio.Task]:
+  """ Starts process with stdout and stderr read by capture. Returns process and reader task. """
+  if os.name == "nt":
+    process = await asyncio.create_subprocess_exec(*args, cwd=cwd,
+          stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return process, asyncio.create_task(capture.read_stream(process.stdout))
+
+  # Create pipe directly so the buffer size can be increased
+  read_fd, write_fd = os.pipe()
+  try:
+    import fcntl
+    fcntl.fcntl(write_fd, F_SETPIPE_SZ, PIPE_SIZE)
+  except Exception as ex:
+    # Not supported on this platform, or size exceeds limit
+    log_error(f"Failed to set console pipe size: {type(ex).__name__} ({ex})")
+  try:
+    process = await asyncio.create_subprocess_exec(*args, cwd=cwd,
+          stdin=subprocess.DEVNULL, stdout=write_fd, stderr=subprocess.STDOUT)
+  except BaseException:
+    os.close(read_fd)
+    raise
+  finally:
+    os.close(write_fd)
+
+  reader = asyncio.StreamReader(limit=READ_SIZE)
+  await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                     os.fdopen(read_fd, "rb", buffering=0))
+  return process, asyncio.create_task(capture.read_stream(reader))
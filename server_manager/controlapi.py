@@ -0,0 +1,71 @@
+"""
+Local control socket for the server manager. Requests and responses are JSON objects,
+one per line, over a Unix domain socket. Multiple requests can be sent on the same
+connection.
+
+Request format:
+  {"command": "<command>", "servers": ["<name>", ...]}
+
+Commands are implemented by the manager; this module only handles the connection
+and message framing. Responses always include an "ok" field, and an "error" field
+if the request failed.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import typing
+
+# Limit on request line length
+MAX_REQUEST_SIZE = 1024 * 1024
+
+class ControlError(Exception):
+  """ Raised by command handlers to return an error response. """
+  pass
+
+def handle_request_line(line:bytes, handle_command:typing.Callable[[dict], dict]) -> dict:
+  try:
+    request = json.loads(line)
+    if not isinstance(request, dict) or not isinstance(request.get("command"), str):
+      raise ControlError("request must be an object with a 'command' string")
+    return {"ok": True, **handle_command(request)}
+  except ControlError as ex:
+    return {"ok": False, "error": str(ex)}
+  except json.JSONDecodeError as ex:
+    return {"ok": False, "error": f"invalid json: {ex}"}
+  except Exception as ex:
+    return {"ok": False, "error": f"{type(ex).__name__} ({ex})"}
+
+async def start_control_server(path:str, handle_command:typing.Callable[[dict], dict]) -> asyncio.AbstractServer:
+  """ Starts listening on Unix socket at path. handle_command is called with each request
+  and returns fields to include in the response. """
+  async def handle_connection(reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+    try:
+      while line := await reader.readline():
+        if not line.strip():
+          continue
+        response = handle_request_line(line, handle_command)
+        writer.write(json.dumps(response).encode("utf-8") + b"\n")
+        await writer.drain()
+    except Exception:
+      pass
+    finally:
+      writer.close()
+
+  # Remove socket left from a previous run
+  if os.path.exists(path):
+    os.remove(path)
+  server = await asyncio.start_unix_server(handle_connection, path, limit=MAX_REQUEST_SIZE)
+  os.chmod(path, 0o600)
+  return server
+
+def send_request(path:str, request:dict, timeout:float=10) -> dict:
+  """ Sends request to control socket and returns response. For use by scripts and tools
+  outside the manager. """
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    sock.settimeout(timeout)
+    sock.connect(path)
+    sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+    with sock.makefile("rb") as response:
+      return json.loads(response.readline())
@@ -24,16 +24,60 @@ import time
 import signal
 import stat
 import platform
+import serverstatus
+import configwatch
+import controlapi
+import managerlog
+import consolecapture
+import placement
+import startup
+import procstats
 
 # Arbitrary value
 MONITOR_PORT = 15267
 
+# Port for Prometheus metrics endpoint, only accessible from this machine
+METRICS_PORT = 15268
+
+# Status replies slower than the recent median by more than this are logged as hitches.
+# Can be overridden per server with "hitch_threshold_ms" in config.json.
+DEFAULT_HITCH_THRESHOLD_MS = 250
+
+# Interval for writing per-server status_stats.json files and for RTT summaries in manager.log
+STATS_WRITE_INTERVAL = 60
+STATS_LOG_INTERVAL = 300
+
+# Maximum number of servers in startup phase (from process start until first status reply)
+# at the same time, or 0 for unlimited. Can be set with "startup_concurrency" in
+# manager_config.json.
+DEFAULT_STARTUP_CONCURRENCY = 4
+
+# Interval to retry status queries while waiting for a starting server to respond
+STARTUP_QUERY_INTERVAL = 0.5
+
+# Time after which a server still starting no longer holds a startup slot
+STARTUP_SLOT_TIMEOUT = 120
+
+# Interval to sample CPU, memory, and IO usage of server processes, or 0 to disable.
+# Can be set with "resource_sample_interval" in manager_config.json.
+DEFAULT_RESOURCE_SAMPLE_INTERVAL = 10
+
+# Number of recent console lines written to the server's manager.log when it crashes or
+# is restarted due to being unresponsive
+CONSOLE_DUMP_LINES = 50
+
 base_directory = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 resource_loader_directory = os.path.abspath(os.path.join(base_directory, "resource_loader"))
 shared_config_directory = os.path.abspath(os.path.join(base_directory, "shared_config"))
 manager_directory = os.path.join(base_directory, "server_manager")
 servers_directory = os.path.join(manager_directory, "servers")
 
+# Optional settings for the manager itself
+manager_config_path = os.path.join(manager_directory, "manager_config.json")
+
+# Unix socket for control commands, see handle_control_command
+control_socket_path = os.path.join(manager_directory, "manager.sock")
+
 # Should match output directory in resource_loader/run_export.py
 resource_output_directory = os.path.join(resource_loader_directory, "output")
 
@@ -41,16 +85,36 @@ resource_serverdata_directory = os.path.join(resource_output_directory, "data",
 
 servers = {}
 
+# Status token => Server, for dispatching status responses
+servers_by_token = {}
+
+# Set in main()
+startup_scheduler = None
+resource_sample_interval = DEFAULT_RESOURCE_SAMPLE_INTERVAL
+
+# Server name => CPU for servers with automatic CPU affinity
+cpu_assignments = {}
+
+# Server name => (active, config.json "active" value) for servers started or stopped through
+# the control socket. Overrides last until the "active" value in config.json changes.
+control_overrides = {}
+
+log_writer = managerlog.LogWriter()
+
 def log_message(msg):
-  with open(os.path.join(manager_directory, "manager.log"), "a", encoding="utf-8") as logfile:
-    logfile.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {msg}\n")
+  log_writer.write(os.path.join(manager_directory, "manager.log"), f"{time.strftime('%Y-%m-%d %H:%M:%S')} {msg}\n")
   print(msg)
 
 def log_server_message(server_name, msg):
-  with open(os.path.join(servers_directory, server_name, "manager.log"), "a", encoding="utf-8") as logfile:
-    logfile.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {msg}\n")
+  log_writer.write(os.path.join(servers_directory, server_name, "manager.log"),
+                   f"{time.strftime('%Y-%m-%d %H:%M:%S')} {msg}\n")
   print(f"{server_name}: {msg}")
 
+def log_console_dump(server_name, lines):
+  path = os.path.join(servers_directory, server_name, "manager.log")
+  for line in lines:
+    log_writer.write(path, f"{time.strftime('%Y-%m-%d %H:%M:%S')}   | {line}\n")
+
 def make_executable(file_path):
   try:
     current = os.stat(file_path).st_mode
@@ -122,48 +186,118 @@ def get_server_args(server_name, config):
   make_executable(server_bin)
   return args, basedir
 
+def get_hitch_threshold(server_name, config):
+  threshold = config.get("hitch_threshold_ms", DEFAULT_HITCH_THRESHOLD_MS)
+  if isinstance(threshold, (int, float)) and not isinstance(threshold, bool) and threshold > 0:
+    return threshold
+  log_server_message(server_name, f"Invalid hitch_threshold_ms '{threshold}', expected positive number; "
+                     f"using default {DEFAULT_HITCH_THRESHOLD_MS}.")
+  return DEFAULT_HITCH_THRESHOLD_MS
+
 class Server():
-  def __init__(self, server_name, config, status_socket):
+  def __init__(self, server_name, config, status_transport):
     self.process = None
     self.server_name = server_name
     self.config = config
     self.address_available_checked = False
-    self.status_socket = status_socket
+    self.status_transport = status_transport
     self.status_token = ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) \
                                 for _ in range(12)).encode()
+    servers_by_token[self.status_token] = self
     self.initial_status = asyncio.Event()
     self.status_pending = 0
-    self.task = asyncio.create_task(self.run_server(status_socket))
+    self.status = serverstatus.ServerStatus()
+    self.rtt = serverstatus.RttTracker(get_hitch_threshold(server_name, config) / 1000)
+    self.console = consolecapture.ConsoleCapture(os.path.join(servers_directory, server_name, "console.log"),
+                                                 log_writer)
+    self.console_task = None
+    # (pid, cpus) most recently applied for automatic affinity
+    self.applied_affinity = None
+    self.resources = procstats.ResourceMonitor(procstats.ResourceLimits(config), resource_sample_interval or 1)
+    for error in self.resources.errors:
+      log_server_message(server_name, error)
+    self.task = asyncio.create_task(self.run_server())
   
-  def check_udp_message(self, data):
-    if self.status_token in data:
-      self.initial_status.set()
-      self.status_pending = 0
+  def check_udp_message(self, data, sequence):
+    """ Called for status responses with this server's token. """
+    self.initial_status.set()
+    self.status_pending = 0
+    if response := serverstatus.parse_status_response(data):
+      self.status.update(response)
+    if sequence.isdigit():
+      self.check_rtt(int(sequence))
+
+  def check_rtt(self, sequence):
+    if hitch := self.rtt.reply_received(sequence):
+      rtt, baseline = hitch
+      log_server_message(self.server_name, f"Status reply hitch: {rtt * 1000:.1f}ms (baseline {baseline * 1000:.1f}ms)")
+
+  def is_up(self):
+    return self.process != None and self.process.returncode == None and \
+      self.initial_status.is_set() and self.status_pending <= 1
 
   def send_status_query(self):
     ip = "127.0.0.1" if self.config["ip"] == "0.0.0.0" else self.config["ip"]
-    self.status_socket.sendto(b"\xff\xff\xff\xffgetstatus " + self.status_token,
-                              (ip, self.config["port"]))
+    # Server echoes this back as the challenge value in "<token>.<sequence>" format
+    sequence = self.rtt.query_sent()
+    self.status_transport.sendto(b"\xff\xff\xff\xffgetstatus " + self.status_token + f".{sequence}".encode(),
+                                 (ip, self.config["port"]))
 
-  async def start_server(self, status_socket):
+  async def start_server(self):
     self.status_pending = 0
     self.initial_status.clear()
+    self.status.reset()
+    self.rtt.clear_pending()
 
-    args, cwd = get_server_args(self.server_name, self.config)
-
-    self.process = await asyncio.create_subprocess_exec(*args, cwd=cwd,
-          stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    while True:
-      assert self.process.returncode == None
-      try:
-        self.send_status_query()
-        await asyncio.wait_for(self.initial_status.wait(), timeout=2)
-        break
-      except asyncio.TimeoutError:
-        pass
-
-    log_server_message(self.server_name, "Server confirmed reachable.")
+    wait_start = time.monotonic()
+    await startup_scheduler.acquire(self, self.server_name, get_startup_priority(self.config))
+    start_time = time.monotonic()
+    try:
+      args, cwd = get_server_args(self.server_name, self.config)
+
+      self.process, self.console_task = await consolecapture.start_process(args, cwd, self.console,
+            lambda msg: log_server_message(self.server_name, msg))
+      for msg in placement.apply_process_settings(self.process.pid, self.config):
+        log_server_message(self.server_name, msg)
+      rebalance_servers()
+
+      while True:
+        assert self.process.returncode == None
+        if self in startup_scheduler.active and time.monotonic() - start_time > STARTUP_SLOT_TIMEOUT:
+          log_server_message(self.server_name, f"Startup exceeded {STARTUP_SLOT_TIMEOUT}s; releasing startup slot.")
+          startup_scheduler.release(self)
+        try:
+          self.send_status_query()
+          await asyncio.wait_for(self.initial_status.wait(), timeout=STARTUP_QUERY_INTERVAL)
+          break
+        except asyncio.TimeoutError:
+          pass
+
+      duration = time.monotonic() - start_time
+      wait_time = start_time - wait_start
+      log_server_message(self.server_name, f"Server confirmed reachable (startup took {duration:.1f}s" +
+                         (f", waited {wait_time:.1f}s for startup slot)." if wait_time >= 0.1 else ")."))
+      startup_scheduler.release(self, duration)
+    finally:
+      startup_scheduler.release(self)
+
+  async def dump_console(self, wait_for_output):
+    if wait_for_output and self.console_task:
+      # Give reader a chance to collect final output from the ended process
+      await asyncio.wait({self.console_task}, timeout=2)
+    lines = self.console.get_lines(CONSOLE_DUMP_LINES)
+    log_server_message(self.server_name, f"Last {len(lines)} console lines:")
+    log_console_dump(self.server_name, lines)
+
+  def set_auto_affinity(self, cpus):
+    if self.applied_affinity == (self.process.pid, cpus):
+      return
+    self.applied_affinity = (self.process.pid, cpus)
+    try:
+      placement.set_affinity(self.process.pid, cpus)
+      log_server_message(self.server_name, f"Automatic CPU affinity set to {cpus}.")
+    except Exception as ex:
+      log_server_message(self.server_name, f"Failed to set CPU affinity: {type(ex).__name__} ({ex})")
 
   def check_port_conflict(self, other):
     if self.config["ip"] == other.config["ip"] and self.config["port"] == other.config["port"]:
@@ -173,7 +307,7 @@ class Server():
       return True
     return False
 
-  async def run_server(self, status_socket):
+  async def run_server(self):
     # Some basic checks to try to avoid starting two servers on the same port
     port_warned = False
     while any(server.server_name != self.server_name and server.address_available_checked and \
@@ -188,19 +322,21 @@ class Server():
     await asyncio.sleep(1)
 
     try:
-      await self.start_server(status_socket)
+      await self.start_server()
       while(True):
         await asyncio.sleep(5)
         if self.process.returncode != None:
           log_server_message(self.server_name, f"Restarting due to process ended (code {self.process.returncode})")
+          await self.dump_console(True)
           await asyncio.sleep(5)
-          await self.start_server(status_socket)
+          await self.start_server()
           continue
         elif self.status_pending >= 10:
           log_server_message(self.server_name, "Restarting due to being unresponsive.")
+          await self.dump_console(False)
           self.process.kill()
           await asyncio.sleep(5)
-          await self.start_server(status_socket)
+          await self.start_server()
           continue
 
         if self.status_pending > 0:
@@ -210,8 +346,12 @@ class Server():
         self.send_status_query()
     except Exception as ex:
       log_server_message(self.server_name, f"ERROR: {type(ex).__name__} ({ex})")
+      if self.process and self.process.returncode != None:
+        await self.dump_console(True)
 
   def shutdown(self):
+    if servers_by_token.get(self.status_token) is self:
+      servers_by_token.pop(self.status_token)
     try:
       if self.process:
         self.process.kill()
@@ -219,51 +359,168 @@ class Server():
       print(f"exception on '{self.server_name}' shutdown: {type(ex).__name__} ({ex})")
     try:
       self.task.cancel()
+      if self.console_task:
+        self.console_task.cancel()
     except Exception as ex:
       print(f"exception on '{self.server_name}' task cancel: {type(ex).__name__} ({ex})")
 
-async def udp_monitor(sock):
-  loop = asyncio.get_running_loop()
+class StatusProtocol(asyncio.DatagramProtocol):
+  """ Receives status responses on the monitor socket. Packets are handled directly in the
+  event loop's read callback and dispatched by token, so cost per packet doesn't depend on
+  the number of servers. """
+  def datagram_received(self, data, addr):
+    challenge = serverstatus.get_challenge(data)
+    if challenge:
+      token, _, sequence = challenge.partition(b".")
+      if server := servers_by_token.get(token):
+        server.check_udp_message(data, sequence)
+
+  def error_received(self, exc):
+    # Happens on Windows due to outgoing message errors
+    pass
 
-  while True:
-    # Wait for a packet to be received
-    try:
-      data = await loop.sock_recv(sock, 2048)
-    except Exception as ex:
-      # Happens on Windows due to outgoing message errors
-      continue
+def get_metrics_text():
+  writer = serverstatus.MetricsWriter()
+  for server_name, server in servers.items():
+    serverstatus.write_status_metrics(writer, server_name, server.status, server.is_up())
+    serverstatus.write_rtt_metrics(writer, server_name, server.rtt)
+    procstats.write_resource_metrics(writer, server_name, server.resources)
+  return writer.get_text()
 
-    for server_name, server in servers.items():
-      server.check_udp_message(data)
+async def handle_metrics_request(reader, writer):
+  try:
+    request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+    # Skip headers
+    while (line := await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+      pass
+    path = request_line.split(b" ")[1] if request_line.count(b" ") >= 2 else b""
+    if path.split(b"?")[0] == b"/metrics":
+      status = "200 OK"
+      body = get_metrics_text().encode("utf-8")
+    else:
+      status = "404 Not Found"
+      body = b"not found\n"
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("utf-8") + body)
+    await writer.drain()
+  except Exception:
+    pass
+  finally:
+    writer.close()
+
+def write_server_stats(server):
+  path = os.path.join(servers_directory, server.server_name, "status_stats.json")
+  stats = {"updated": time.strftime('%Y-%m-%d %H:%M:%S'), **server.rtt.export_serializable(),
+           "resources": server.resources.latest}
+  with open(path + ".tmp", "w", encoding="utf-8") as tgt:
+    json.dump(stats, tgt, indent=2)
+  os.replace(path + ".tmp", path)
+
+async def stats_monitor():
+  last_log = time.monotonic()
+  while True:
+    await asyncio.sleep(STATS_WRITE_INTERVAL)
+    log_summary = time.monotonic() - last_log >= STATS_LOG_INTERVAL
+    if log_summary:
+      last_log = time.monotonic()
+    for server_name, server in list(servers.items()):
+      try:
+        write_server_stats(server)
+        if log_summary and (summary := server.rtt.get_summary("5m")):
+          log_message(f"{server_name}: {summary}")
+      except Exception as ex:
+        log_server_message(server_name, f"Error writing stats: {type(ex).__name__} ({ex})")
 
-def list_subdirectories(dir):
-  return [d for d in os.listdir(dir) if os.path.isdir(os.path.join(dir, d))]
+async def resource_monitor(interval, status_transport):
+  while True:
+    await asyncio.sleep(interval)
+    for server_name, server in list(servers.items()):
+      process = server.process
+      if not process or process.returncode != None:
+        continue
+      try:
+        if server.resources.pid != process.pid:
+          server.resources.reset(process.pid, procstats.ProcReader(process.pid))
+        events, restart_reason = server.resources.update()
+      except OSError:
+        # Process may have exited since the check
+        continue
+      for event in events:
+        log_server_message(server_name, event)
+      if restart_reason and servers.get(server_name) is server:
+        restart_server(server_name, server.config, status_transport, f"Server restarting due to {restart_reason}.")
 
 class Config():
-  def __init__(self):
+  def __init__(self, cache=None):
     try:
       self.servers = {}
       self.error = None
-
-      for server_name in list_subdirectories(servers_directory):
-        try:
-          config_path = os.path.join(servers_directory, server_name, "config.json")
-          with open(config_path, "r", encoding="utf-8") as src:
-            config = json.load(src)
-        except Exception as ex:
-          config = {"error": str(ex)}
-        self.servers[server_name] = config
+      if not cache:
+        cache = configwatch.ConfigCache(servers_directory)
+      self.servers = cache.read_configs()
     
     except Exception as ex:
       self.servers = {}
       self.error = f"{type(ex).__name__} ({ex})"
 
-async def update_servers(config:Config, status_socket):
-  active_configs = {name: svconfig for name, svconfig in config.servers.items() if svconfig.get("active")}
-  for name, svconfig in active_configs.items():
+def is_server_active(name, svconfig):
+  config_active = bool(svconfig.get("active"))
+  if override := control_overrides.get(name):
+    if override[1] == config_active and not svconfig.get("error"):
+      return override[0]
+    control_overrides.pop(name)
+  return config_active
+
+def get_startup_priority(config):
+  priority = config.get("startup_priority", 0)
+  return priority if isinstance(priority, int) else 0
+
+def read_manager_config():
+  if not os.path.exists(manager_config_path):
+    return {}
+  try:
+    with open(manager_config_path, "r", encoding="utf-8") as src:
+      manager_config = json.load(src)
+  except Exception as ex:
+    log_message(f"Error reading manager_config.json: {type(ex).__name__} ({ex})")
+    return {}
+  if not isinstance(manager_config, dict):
+    log_message(f"Error reading manager_config.json: expected object, got {type(manager_config).__name__}")
+    return {}
+  return manager_config
+
+def restart_server(name, svconfig, status_transport, msg):
+  log_server_message(name, msg)
+  servers.pop(name).shutdown()
+  servers[name] = Server(name, svconfig, status_transport)
+
+def rebalance_servers():
+  """ Spreads running servers with "cpu_affinity": "auto" across CPUs not used by servers
+  with a fixed affinity. Called when servers are started or stopped. """
+  global cpu_assignments
+  if not placement.affinity_supported():
+    return
+  running = {name: server for name, server in servers.items() if server.process and server.process.returncode == None}
+  reserved = set()
+  for server in running.values():
+    try:
+      reserved.update(placement.get_fixed_affinity(server.config) or [])
+    except ValueError:
+      pass
+  all_cpus = placement.get_available_cpus()
+  cpus = [cpu for cpu in all_cpus if not cpu in reserved] or all_cpus
+  auto_names = sorted(name for name, server in running.items() if server.config.get("cpu_affinity") == "auto")
+  cpu_assignments = placement.assign_cpus(auto_names, cpus, cpu_assignments)
+  for name in auto_names:
+    running[name].set_auto_affinity([cpu_assignments[name]])
+
+async def update_servers(config:Config, status_transport):
+  active_configs = {name: svconfig for name, svconfig in config.servers.items() if is_server_active(name, svconfig)}
+  # Start in priority order, so higher priority servers request startup slots first
+  for name, svconfig in sorted(active_configs.items(), key=lambda item: (-get_startup_priority(item[1]), item[0])):
     if not name in servers:
       log_server_message(name, "Server starting.")
-      servers[name] = Server(name, svconfig, status_socket)
+      servers[name] = Server(name, svconfig, status_transport)
   for name in list(servers):
     if not name in active_configs:
       log_server_message(name, "Server stopping due to config.json")
@@ -273,35 +530,166 @@ async def update_servers(config:Config, status_socket):
       new_config = active_configs[name]
       old_config = servers[name].config
       if new_config.get("restart_count") != old_config.get("restart_count"):
-        log_server_message(name, "Server restarting due to config.json restart count")
-        servers[name].shutdown()
-        servers.pop(name)
-        servers[name] = Server(name, new_config, status_socket)
+        restart_server(name, new_config, status_transport, "Server restarting due to config.json restart count")
+  rebalance_servers()
+
+def get_server_status(name, svconfig):
+  result = {"configured": svconfig != None, "config_active": bool(svconfig and svconfig.get("active")),
+            "running": name in servers}
+  if svconfig and svconfig.get("error"):
+    result["config_error"] = svconfig["error"]
+  if name in control_overrides:
+    result["control_override"] = "start" if control_overrides[name][0] else "stop"
+  if server := servers.get(name):
+    result["address"] = f"{server.config['ip']}:{server.config['port']}"
+    result["pid"] = server.process.pid if server.process else None
+    result["up"] = server.is_up()
+    result["missed_queries"] = server.status_pending
+    if name in cpu_assignments:
+      result["auto_cpu"] = cpu_assignments[name]
+    result["resources"] = server.resources.latest
+    if server.status.response and server.status.response_time != None:
+      players = server.status.response.players
+      result["map"] = server.status.map_name
+      result["players"] = len([player for player in players if not player.is_bot()])
+      result["bots"] = len([player for player in players if player.is_bot()])
+      result["status_age"] = round(time.monotonic() - server.status.response_time, 3)
+    result.update(server.rtt.export_serializable())
+  return result
+
+def control_server(command, name, svconfig, status_transport):
+  """ Performs start, stop, or restart command for a single server. """
+  if command == "start":
+    if not svconfig:
+      return {"ok": False, "error": "server not found"}
+    if svconfig.get("error"):
+      return {"ok": False, "error": f"config error: {svconfig['error']}"}
+    control_overrides[name] = (True, bool(svconfig.get("active")))
+    if name in servers:
+      return {"ok": True, "result": "already running"}
+    log_server_message(name, "Server starting due to control command.")
+    servers[name] = Server(name, svconfig, status_transport)
+    return {"ok": True, "result": "started"}
+
+  if command == "stop":
+    if svconfig and not svconfig.get("error"):
+      control_overrides[name] = (False, bool(svconfig.get("active")))
+    if not name in servers:
+      return {"ok": True, "result": "not running"}
+    log_server_message(name, "Server stopping due to control command.")
+    servers.pop(name).shutdown()
+    rebalance_servers()
+    return {"ok": True, "result": "stopped"}
+
+  if command == "restart":
+    if not name in servers:
+      return {"ok": False, "error": "not running"}
+    if not svconfig or svconfig.get("error"):
+      return {"ok": False, "error": "config error: " + (svconfig["error"] if svconfig else "server not found")}
+    restart_server(name, svconfig, status_transport, "Server restarting due to control command.")
+    return {"ok": True, "result": "restarted"}
+
+def get_request_servers(request, config, required):
+  names = request.get("servers")
+  if names == None:
+    if required:
+      raise controlapi.ControlError("'servers' list required")
+    return sorted(set(config.servers) | set(servers))
+  if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+    raise controlapi.ControlError("'servers' must be a list of server names")
+  return names
+
+def handle_control_command(request, config_cache, status_transport):
+  """ Commands:
+    list: running state of all servers
+    status: detailed status of servers, or all servers if no list is specified
+    start, stop, restart: perform command on each server in list
+    console: recent console output of servers in list, up to "lines" (default 50) per server
+  Start and stop take precedence over the config.json "active" setting until it is changed. """
+  command = request["command"]
+  config = Config(config_cache)
+  if command == "list":
+    return {"servers": [{"name": name, "running": name in servers, "up": name in servers and servers[name].is_up()}
+                        for name in get_request_servers(request, config, False)]}
+  if command == "status":
+    return {"servers": {name: get_server_status(name, config.servers.get(name))
+                        for name in get_request_servers(request, config, False)}}
+  if command == "console":
+    count = request.get("lines", CONSOLE_DUMP_LINES)
+    if not isinstance(count, int):
+      raise controlapi.ControlError("'lines' must be an integer")
+    return {"servers": {name: servers[name].console.get_lines(count) if name in servers else None
+                        for name in get_request_servers(request, config, True)}}
+  if command in ("start", "stop", "restart"):
+    if config.error:
+      raise controlapi.ControlError(f"error reading config: {config.error}")
+    return {"results": {name: control_server(command, name, config.servers.get(name), status_transport)
+                        for name in get_request_servers(request, config, True)}}
+  raise controlapi.ControlError(f"unknown command '{command}'")
 
 async def main():
+  global startup_scheduler, resource_sample_interval
+  manager_config = read_manager_config()
+  startup_concurrency = manager_config.get("startup_concurrency", DEFAULT_STARTUP_CONCURRENCY)
+  if not isinstance(startup_concurrency, int) or startup_concurrency < 0:
+    log_message(f"Invalid startup_concurrency '{startup_concurrency}', using default.")
+    startup_concurrency = DEFAULT_STARTUP_CONCURRENCY
+  startup_scheduler = startup.StartupScheduler(startup_concurrency, log_message)
+  resource_sample_interval = manager_config.get("resource_sample_interval", DEFAULT_RESOURCE_SAMPLE_INTERVAL)
+  if not isinstance(resource_sample_interval, (int, float)) or resource_sample_interval < 0:
+    log_message(f"Invalid resource_sample_interval '{resource_sample_interval}', using default.")
+    resource_sample_interval = DEFAULT_RESOURCE_SAMPLE_INTERVAL
+
   sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
   sock.bind(("0.0.0.0", MONITOR_PORT))
   sock.setblocking(False)
+  status_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(StatusProtocol, sock=sock)
+  # Stopped when main exits
+  background_tasks = [asyncio.create_task(stats_monitor())]
+  listeners = []
+  if resource_sample_interval and procstats.is_supported():
+    background_tasks.append(asyncio.create_task(resource_monitor(resource_sample_interval, status_transport)))
 
-  udp_monitor_task = asyncio.create_task(udp_monitor(sock))
-
-  current_config = Config()
-  await update_servers(current_config, sock)
+  try:
+    listeners.append(await asyncio.start_server(handle_metrics_request, "127.0.0.1", METRICS_PORT))
+  except Exception as ex:
+    log_message(f"Failed to start metrics endpoint: {type(ex).__name__} ({ex})")
 
-  while(True):
-    await asyncio.sleep(1)
-    new_config = Config()
+  config_watcher = configwatch.ConfigWatcher(servers_directory)
+  if not config_watcher.is_event_driven():
+    log_message(f"Config change notifications unavailable, using polling: {config_watcher.inotify_error}")
 
-    # Log config errors
-    if new_config.error and new_config.error != current_config.error:
-      log_message(f"Error reading config: {new_config.error}")
-    for server_name, server_config in new_config.servers.items():
-      if server_config.get("error") and server_config.get("error") != \
-          current_config.servers.get("server_name", {}).get("error"):
-        log_server_message(server_name, f"Error reading config: {server_config['error']}")
-    current_config = new_config
+  try:
+    listeners.append(await controlapi.start_control_server(control_socket_path,
+          lambda request: handle_control_command(request, config_watcher.cache, status_transport)))
+  except Exception as ex:
+    log_message(f"Failed to start control socket: {type(ex).__name__} ({ex})")
 
-    await update_servers(new_config, sock)
+  try:
+    current_config = Config(config_watcher.cache)
+    await update_servers(current_config, status_transport)
+
+    while(True):
+      await config_watcher.wait()
+      new_config = Config(config_watcher.cache)
+
+      # Log config errors
+      if new_config.error and new_config.error != current_config.error:
+        log_message(f"Error reading config: {new_config.error}")
+      for server_name, server_config in new_config.servers.items():
+        if server_config.get("error") and server_config.get("error") != \
+            current_config.servers.get(server_name, {}).get("error"):
+          log_server_message(server_name, f"Error reading config: {server_config['error']}")
+      current_config = new_config
+
+      await update_servers(new_config, status_transport)
+
+  finally:
+    for task in background_tasks:
+      task.cancel()
+    for listener in listeners:
+      listener.close()
+    config_watcher.close()
 
 def register_signal(sig, msg):
   def handler(signum, frame):
@@ -311,19 +699,58 @@ def register_signal(sig, msg):
   except Exception as ex:
     print(f"register_signal failed: {type(ex).__name__} ({ex})")
 
+async def shutdown_servers():
+  """ Kills server processes and waits for them to exit, so they are cleaned up before the
+  event loop is closed. """
+  processes = [server.process for server in servers.values() if server.process and server.process.returncode == None]
+  for server in servers.values():
+    server.shutdown()
+  servers.clear()
+  if processes:
+    await asyncio.wait([asyncio.create_task(process.wait()) for process in processes], timeout=5)
+
+async def run_main():
+  """ Runs main with SIGTERM and SIGINT handled by the event loop where supported. With only
+  the register_signal handler, the exception can be raised inside any task, which just ends
+  that task instead of the manager. """
+  loop = asyncio.get_running_loop()
+  main_task = asyncio.create_task(main())
+  termination_reason = []
+  def handler(msg):
+    termination_reason.append(msg)
+    main_task.cancel()
+  for sig, msg in ((signal.SIGTERM, "Received SIGTERM"), (signal.SIGINT, "Received SIGINT")):
+    try:
+      loop.add_signal_handler(sig, handler, msg)
+    except (NotImplementedError, RuntimeError):
+      pass
+  try:
+    await main_task
+  except asyncio.CancelledError:
+    if termination_reason:
+      raise BaseException(termination_reason[0])
+    raise
+  finally:
+    await shutdown_servers()
+
 def run_manager():
   global servers
   try:
     log_message(f"Manager starting.")
     register_signal(signal.SIGTERM, "Received SIGTERM")
     register_signal(signal.SIGINT, "Received SIGINT")
-    asyncio.run(main())
+    asyncio.run(run_main())
 
   except BaseException as ex:
     log_message(f"Manager terminating: {type(ex).__name__} ({ex})")
     for server_name, server in servers.items():
       server.shutdown()
     servers = {}
+    try:
+      os.remove(control_socket_path)
+    except Exception:
+      pass
+    log_writer.close()
     sys.exit(0)
 
 def run_test_server(server_name):
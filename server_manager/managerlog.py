@@ -0,0 +1,129 @@
+"""
+Buffered log file writing for the manager. Lines are queued in memory and written by a
+background thread, so logging doesn't block the event loop on disk access. Log files are
+rotated when they exceed a size limit or on the first write of a new day, and rotated
+files are compressed with gzip.
+"""
+
+import atexit
+import gzip
+import os
+import shutil
+import threading
+import time
+
+# Interval to write queued lines to disk
+FLUSH_INTERVAL = 1
+
+# Rotate when file exceeds this size
+MAX_FILE_SIZE = 10 * 1024 * 1024
+
+# Number of compressed rotated files to keep for each log
+KEEP_ROTATED = 10
+
+# Limit on lines queued for one file, in case writes are stalled
+MAX_PENDING_LINES = 10000
+
+class LogFile():
+  def __init__(self, path:str):
+    self.path = path
+    self.pending : list[str] = []
+    self.dropped = 0
+    self.error : str|None = None
+
+  def get_rotated_files(self) -> list[str]:
+    directory, name = os.path.split(self.path)
+    return sorted(filename for filename in os.listdir(directory)
+                  if filename.startswith(name + ".") and filename.endswith(".gz"))
+
+  def rotate(self, file_time:float):
+    """ Moves current file to compressed file named by its modification time. """
+    directory = os.path.dirname(self.path)
+    rotated_path = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S', time.localtime(file_time))}.gz"
+    temp_path = self.path + ".rotating"
+    os.replace(self.path, temp_path)
+    with open(temp_path, "rb") as src, gzip.open(rotated_path, "wb") as tgt:
+      shutil.copyfileobj(src, tgt)
+    os.remove(temp_path)
+    rotated_files = self.get_rotated_files()
+    for filename in rotated_files[:max(0, len(rotated_files) - KEEP_ROTATED)]:
+      os.remove(os.path.join(directory, filename))
+
+  def check_rotate(self):
+    try:
+      stat = os.stat(self.path)
+    except FileNotFoundError:
+      return
+    if stat.st_size == 0:
+      return
+    if stat.st_size >= MAX_FILE_SIZE or time.localtime(stat.st_mtime)[:3] != time.localtime()[:3]:
+      self.rotate(stat.st_mtime)
+
+  def write(self, lines:list[str]):
+    self.check_rotate()
+    with open(self.path, "a", encoding="utf-8") as logfile:
+      logfile.write("".join(lines))
+
+class LogWriter():
+  """ Queues lines for log files and writes them from a background thread. """
+  def __init__(self):
+    self.files : dict[str, LogFile] = {}
+    self.lock = threading.Lock()
+    # Held while writing to files, so flushes from different threads don't overlap
+    self.write_lock = threading.Lock()
+    self.wake = threading.Event()
+    self.thread : threading.Thread|None = None
+    self.closed = False
+
+  def write(self, path:str, line:str):
+    with self.lock:
+      if not (log_file := self.files.get(path)):
+        log_file = self.files[path] = LogFile(path)
+      if len(log_file.pending) >= MAX_PENDING_LINES:
+        log_file.dropped += 1
+      else:
+        log_file.pending.append(line)
+      if not self.thread and not self.closed:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+    if self.closed:
+      # Background thread no longer running, so write directly
+      self.flush()
+
+  def flush(self):
+    """ Writes all queued lines. """
+    with self.lock:
+      batches = []
+      for log_file in self.files.values():
+        if log_file.pending or log_file.dropped:
+          lines = log_file.pending
+          if log_file.dropped:
+            lines.append(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {log_file.dropped} log lines dropped\n")
+          batches.append((log_file, lines))
+          log_file.pending = []
+          log_file.dropped = 0
+    with self.write_lock:
+      for log_file, lines in batches:
+        try:
+          log_file.write(lines)
+          log_file.error = None
+        except Exception as ex:
+          # Only print each distinct error once, to avoid repeating every flush
+          error = f"{type(ex).__name__} ({ex})"
+          if error != log_file.error:
+            print(f"error writing log file '{log_file.path}': {error}")
+            log_file.error = error
+
+  def run(self):
+    while not self.closed:
+      self.wake.wait(FLUSH_INTERVAL)
+      self.flush()
+
+  def close(self):
+    """ Writes remaining lines and stops background thread. """
+    self.closed = True
+    self.wake.set()
+    if self.thread and self.thread != threading.current_thread():
+      self.thread.join()
+    self.flush()
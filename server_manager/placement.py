@@ -0,0 +1,106 @@
+"""
+CPU affinity and scheduling priority for server processes. Settings are applied to every
+thread of the process, since on Linux affinity and priority are per-thread and only new
+threads inherit them.
+
+config.json settings:
+  "cpu_affinity": list of CPU numbers, or "auto" to be assigned a CPU automatically
+  "nice": niceness value, e.g. -5 for higher priority (requires root for negative values)
+  "ioprio": best-effort IO priority level 0 (highest) to 7 (lowest), or "idle"
+"""
+
+import ctypes
+import os
+import platform
+
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_WHO_PROCESS = 1
+
+# ioprio_set syscall numbers by machine
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "amd64": 251, "i386": 289, "i686": 289, "aarch64": 30, "arm64": 30,
+                       "armv7l": 314, "armv6l": 314}
+
+def affinity_supported() -> bool:
+  return hasattr(os, "sched_setaffinity")
+
+def get_available_cpus() -> list[int]:
+  """ Returns CPUs the manager is allowed to run on. """
+  return sorted(os.sched_getaffinity(0))
+
+def get_thread_ids(pid:int) -> list[int]:
+  try:
+    return [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+  except OSError:
+    return [pid]
+
+def set_affinity(pid:int, cpus:list[int]):
+  for tid in get_thread_ids(pid):
+    os.sched_setaffinity(tid, cpus)
+
+def set_nice(pid:int, nice:int):
+  for tid in get_thread_ids(pid):
+    os.setpriority(os.PRIO_PROCESS, tid, nice)
+
+def get_ioprio_value(setting:int|str) -> int:
+  if setting == "idle":
+    return IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+  if isinstance(setting, int) and not isinstance(setting, bool) and 0 <= setting <= 7:
+    return IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT | setting
+  raise ValueError(f"invalid ioprio '{setting}', expected 0-7 or \"idle\"")
+
+def set_ioprio(pid:int, setting:int|str):
+  value = get_ioprio_value(setting)
+  syscall_number = IOPRIO_SET_SYSCALLS.get(platform.machine().lower())
+  if syscall_number == None or not platform.system() == "Linux":
+    raise OSError("ioprio not supported on this platform")
+  libc = ctypes.CDLL(None, use_errno=True)
+  for tid in get_thread_ids(pid):
+    if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, tid, value) < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno))
+
+def get_fixed_affinity(config:dict) -> list[int]|None:
+  """ Returns CPU list if config specifies one, or None for no fixed affinity. """
+  cpus = config.get("cpu_affinity")
+  if cpus == None or cpus == "auto":
+    return None
+  if not isinstance(cpus, list) or not cpus or not all(isinstance(cpu, int) and cpu >= 0 for cpu in cpus):
+    raise ValueError(f"invalid cpu_affinity '{cpus}', expected list of CPU numbers or \"auto\"")
+  return cpus
+
+def apply_process_settings(pid:int, config:dict) -> list[str]:
+  """ Applies nice, ioprio, and fixed CPU affinity settings from config. Returns messages
+  describing settings applied or errors. """
+  messages : list[str] = []
+  for name, func in (("cpu_affinity", lambda: set_affinity(pid, get_fixed_affinity(config))),
+                     ("nice", lambda: set_nice(pid, config["nice"])),
+                     ("ioprio", lambda: set_ioprio(pid, config["ioprio"]))):
+    if config.get(name) == None or (name == "cpu_affinity" and config[name] == "auto"):
+      continue
+    try:
+      func()
+      messages.append(f"Set {name} to {config[name]}.")
+    except Exception as ex:
+      messages.append(f"Failed to set {name}: {type(ex).__name__} ({ex})")
+  return messages
+
+def assign_cpus(names:list[str], cpus:list[int], previous:dict[str, int]) -> dict[str, int]:
+  """ Returns server name => CPU, spreading servers evenly across cpus. Servers keep their
+  previous CPU where possible, so rebalancing only moves servers from overloaded CPUs. """
+  if not cpus:
+    return {}
+  limit = -(-len(names) // len(cpus))
+  load = {cpu: 0 for cpu in cpus}
+  result : dict[str, int] = {}
+  for name in names:
+    if (cpu := previous.get(name)) in load and load[cpu] < limit:
+      result[name] = cpu
+      load[cpu] += 1
+  for name in names:
+    if not name in result:
+      cpu = min(cpus, key=lambda cpu: load[cpu])
+      result[name] = cpu
+      load[cpu] += 1
+  return result
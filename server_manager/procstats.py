@@ -0,0 +1,224 @@
+"""
+Samples CPU, memory, and disk IO usage of server processes from /proc (Linux only).
+Each sample is compared to the previous one to compute CPU usage and IO rates, and a
+short history is kept to detect sustained memory growth.
+
+Readers are separated from the monitor so FakeProcessReader can stand in for a real
+process, for example:
+
+  reader = FakeProcessReader(rss=100e6, rss_growth=1e6)
+  monitor = ResourceMonitor(ResourceLimits({"restart_on_memory_growth_mb": 50}), 10)
+  monitor.reset(1, reader)
+  for _ in range(400):
+    reader.advance(10)
+    events, restart_reason = monitor.update()
+"""
+
+import collections
+import math
+import os
+import time
+import serverstatus
+
+# Limit on samples kept per server
+MAX_HISTORY_SAMPLES = 10000
+
+class ProcessSample():
+  def __init__(self, time:float, cpu_seconds:float, rss_bytes:int, read_bytes:int|None, write_bytes:int|None):
+    self.time = time
+    self.cpu_seconds = cpu_seconds
+    self.rss_bytes = rss_bytes
+    self.read_bytes = read_bytes
+    self.write_bytes = write_bytes
+
+class ProcReader():
+  """ Reads samples for a process from /proc. """
+  clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+  page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+  def __init__(self, pid:int):
+    self.pid = pid
+    self.io_available = True
+
+  def read_file(self, name:str) -> str:
+    with open(f"/proc/{self.pid}/{name}", "r") as src:
+      return src.read()
+
+  def read_sample(self) -> ProcessSample:
+    # Process name is in parentheses and may contain spaces, so split after it
+    stat_fields = self.read_file("stat").rpartition(")")[2].split()
+    cpu_seconds = (int(stat_fields[11]) + int(stat_fields[12])) / self.clock_ticks
+    rss_bytes = int(self.read_file("statm").split()[1]) * self.page_size
+    read_bytes = write_bytes = None
+    if self.io_available:
+      # Requires same user or ptrace permission, so may not be readable
+      try:
+        io = dict(line.split(": ", 1) for line in self.read_file("io").splitlines() if ": " in line)
+        read_bytes = int(io["read_bytes"])
+        write_bytes = int(io["write_bytes"])
+      except (OSError, KeyError, ValueError):
+        self.io_available = False
+    return ProcessSample(time.monotonic(), cpu_seconds, rss_bytes, read_bytes, write_bytes)
+
+class FakeProcessReader():
+  """ Stand-in for ProcReader with simulated usage and a manually advanced clock. """
+  def __init__(self, cpu_usage:float=0.1, rss:float=100e6, rss_growth:float=0, read_rate:float=0,
+               write_rate:float=0):
+    # cpu_usage is fraction of a core, rss_growth and rates are bytes per second
+    self.cpu_usage = cpu_usage
+    self.rss = rss
+    self.rss_growth = rss_growth
+    self.read_rate = read_rate
+    self.write_rate = write_rate
+    self.time = 0.0
+    self.cpu_seconds = 0.0
+    self.read_bytes = 0.0
+    self.write_bytes = 0.0
+
+  def advance(self, seconds:float):
+    self.time += seconds
+    self.cpu_seconds += self.cpu_usage * seconds
+    self.rss += self.rss_growth * seconds
+    self.read_bytes += self.read_rate * seconds
+    self.write_bytes += self.write_rate * seconds
+
+  def read_sample(self) -> ProcessSample:
+    return ProcessSample(self.time, self.cpu_seconds, int(self.rss), int(self.read_bytes), int(self.write_bytes))
+
+def is_supported() -> bool:
+  return os.path.exists("/proc/self/statm")
+
+class ResourceLimits():
+  """ Thresholds from server config.json:
+    "cpu_warn_percent": log when CPU usage stays above this (default 90)
+    "rss_warn_mb": log when memory usage is above this (default disabled)
+    "restart_on_memory_growth_mb": restart when memory grows by more than this over the
+      growth window (default disabled)
+    "memory_growth_window": seconds of steady growth required for restart (default 3600) """
+  def __init__(self, config:dict):
+    # Invalid settings are replaced by defaults, with messages here for the caller to log
+    self.errors : list[str] = []
+    self.cpu_warn_percent = self.get_setting(config, "cpu_warn_percent", 90)
+    self.rss_warn_mb = self.get_setting(config, "rss_warn_mb", None)
+    self.restart_growth_mb = self.get_setting(config, "restart_on_memory_growth_mb", None)
+    self.growth_window = self.get_setting(config, "memory_growth_window", 3600)
+
+  def get_setting(self, config:dict, name:str, default:float|None) -> float|None:
+    value = config.get(name)
+    if value == None:
+      return default
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0:
+      return value
+    self.errors.append(f"Invalid {name} '{value}', expected positive number; " +
+                       ("setting disabled." if default == None else f"using default {default}."))
+    return default
+
+# Consecutive samples above CPU threshold before logging, so map loads aren't reported
+CPU_WARN_SAMPLES = 3
+
+class ResourceMonitor():
+  def __init__(self, limits:ResourceLimits, interval:float):
+    self.limits = limits
+    # Configuration problems for the caller to log
+    self.errors = list(limits.errors)
+    self.pid : int|None = None
+    self.reader : ProcReader|FakeProcessReader|None = None
+    # Keep enough samples to cover growth window
+    history_samples = math.ceil(limits.growth_window / interval) + 10
+    if history_samples > MAX_HISTORY_SAMPLES:
+      if limits.restart_growth_mb != None:
+        self.errors.append(f"memory_growth_window of {limits.growth_window}s needs more than {MAX_HISTORY_SAMPLES} "
+                           f"samples at {interval}s sample interval; restart_on_memory_growth_mb disabled.")
+        limits.restart_growth_mb = None
+      history_samples = MAX_HISTORY_SAMPLES
+    self.history : collections.deque[ProcessSample] = collections.deque(maxlen=history_samples)
+    self.latest : dict|None = None
+    self.cpu_high_count = 0
+    self.rss_high = False
+
+  def reset(self, pid:int, reader:ProcReader|FakeProcessReader):
+    """ Starts monitoring a new process. """
+    self.pid = pid
+    self.reader = reader
+    self.history.clear()
+    self.latest = None
+    self.cpu_high_count = 0
+    self.rss_high = False
+
+  def get_rates(self, previous:ProcessSample, sample:ProcessSample) -> dict:
+    elapsed = max(sample.time - previous.time, 1e-6)
+    result = {
+      "cpu_percent": round((sample.cpu_seconds - previous.cpu_seconds) / elapsed * 100, 1),
+      "rss_mb": round(sample.rss_bytes / 1024**2, 1),
+    }
+    if sample.read_bytes != None and previous.read_bytes != None and \
+        sample.write_bytes != None and previous.write_bytes != None:
+      result["read_kb_per_sec"] = round((sample.read_bytes - previous.read_bytes) / elapsed / 1024, 1)
+      result["write_kb_per_sec"] = round((sample.write_bytes - previous.write_bytes) / elapsed / 1024, 1)
+    return result
+
+  def check_memory_growth(self) -> float|None:
+    """ Returns growth in MB if memory has grown steadily over the growth window by more
+    than the restart threshold. Steady growth means the average of each quarter of the
+    window is higher than the previous quarter, so a temporary spike doesn't count. """
+    if self.limits.restart_growth_mb == None or len(self.history) < 8:
+      return None
+    latest = self.history[-1]
+    if self.history[0].time > latest.time - self.limits.growth_window * 0.95:
+      # Not enough history yet
+      return None
+    window = [sample for sample in self.history if sample.time >= latest.time - self.limits.growth_window]
+    if len(window) < 8:
+      return None
+    quarter = len(window) // 4
+    averages = [sum(sample.rss_bytes for sample in window[index * quarter:(index + 1) * quarter]) / quarter
+                for index in range(4)]
+    growth = (latest.rss_bytes - min(sample.rss_bytes for sample in window[:quarter])) / 1024**2
+    if all(averages[index] < averages[index + 1] for index in range(3)) and growth > self.limits.restart_growth_mb:
+      return growth
+    return None
+
+  def update(self) -> tuple[list[str], str|None]:
+    """ Takes a sample. Returns list of events to log, and reason if the server should
+    be restarted. """
+    assert self.reader
+    sample = self.reader.read_sample()
+    events : list[str] = []
+    if self.history:
+      self.latest = self.get_rates(self.history[-1], sample)
+      cpu_percent = self.latest["cpu_percent"]
+      if cpu_percent > self.limits.cpu_warn_percent:
+        self.cpu_high_count += 1
+        if self.cpu_high_count == CPU_WARN_SAMPLES:
+          events.append(f"High CPU usage: {cpu_percent}% (threshold {self.limits.cpu_warn_percent}%)")
+      else:
+        if self.cpu_high_count >= CPU_WARN_SAMPLES:
+          events.append(f"CPU usage back to normal: {cpu_percent}%")
+        self.cpu_high_count = 0
+    self.history.append(sample)
+
+    if self.limits.rss_warn_mb != None:
+      rss_mb = sample.rss_bytes / 1024**2
+      if not self.rss_high and rss_mb > self.limits.rss_warn_mb:
+        events.append(f"High memory usage: {rss_mb:.1f} MB (threshold {self.limits.rss_warn_mb} MB)")
+        self.rss_high = True
+      elif self.rss_high and rss_mb < self.limits.rss_warn_mb * 0.9:
+        events.append(f"Memory usage back to normal: {rss_mb:.1f} MB")
+        self.rss_high = False
+
+    if (growth := self.check_memory_growth()) != None:
+      return events, f"memory grew steadily by {growth:.1f} MB over {self.limits.growth_window}s"
+    return events, None
+
+def write_resource_metrics(writer:serverstatus.MetricsWriter, server_name:str, monitor:ResourceMonitor):
+  if not monitor.latest:
+    return
+  labels = {"server": server_name}
+  writer.add("efserver_cpu_percent", "gauge", "CPU usage of server process.", labels, monitor.latest["cpu_percent"])
+  writer.add("efserver_rss_bytes", "gauge", "Resident memory of server process.", labels,
+             monitor.history[-1].rss_bytes)
+  if "read_kb_per_sec" in monitor.latest:
+    writer.add("efserver_disk_read_kb_per_sec", "gauge", "Disk read rate of server process.", labels,
+               monitor.latest["read_kb_per_sec"])
+    writer.add("efserver_disk_write_kb_per_sec", "gauge", "Disk write rate of server process.", labels,
+               monitor.latest["write_kb_per_sec"])
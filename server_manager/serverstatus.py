@@ -0,0 +1,257 @@
+"""
+Parsing of game server getstatus responses, and per-server status metrics in Prometheus
+text format.
+"""
+
+import collections
+import time
+
+STATUS_RESPONSE_HEADER = b"\xff\xff\xff\xffstatusResponse"
+
+class PlayerInfo():
+  def __init__(self, score:int, ping:int, name:str):
+    self.score = score
+    self.ping = ping
+    self.name = name
+
+  def is_bot(self) -> bool:
+    # Bots are listed with zero ping; human clients always have some latency
+    return self.ping == 0
+
+class StatusResponse():
+  def __init__(self, cvars:dict[str, str], players:list[PlayerInfo]):
+    self.cvars = cvars
+    self.players = players
+
+def parse_info_string(text:str) -> dict[str, str]:
+  fields = text.split("\\")
+  if fields and fields[0] == "":
+    fields = fields[1:]
+  return {fields[index]: fields[index + 1] for index in range(0, len(fields) - 1, 2)}
+
+def parse_player_line(line:str) -> PlayerInfo|None:
+  """ Parses player line in 'score ping "name"' format. """
+  fields = line.split(" ", 2)
+  if len(fields) < 3:
+    return None
+  try:
+    return PlayerInfo(int(fields[0]), int(fields[1]), fields[2].strip('"'))
+  except ValueError:
+    return None
+
+def parse_status_response(data:bytes) -> StatusResponse|None:
+  """ Returns parsed response, or None if data is not a status response. """
+  if not data.startswith(STATUS_RESPONSE_HEADER):
+    return None
+  # Game strings aren't necessarily valid utf-8
+  lines = data[len(STATUS_RESPONSE_HEADER):].decode("latin-1").split("\n")
+  if len(lines) < 2:
+    return None
+  players = [player for line in lines[2:] if line and (player := parse_player_line(line))]
+  return StatusResponse(parse_info_string(lines[1]), players)
+
+CHALLENGE_KEY = b"\\challenge\\"
+
+def get_challenge(data:bytes) -> bytes|None:
+  """ Returns challenge value echoed back in status response, without decoding the rest of the
+  response, or None if data is not a status response with a challenge. """
+  if not data.startswith(STATUS_RESPONSE_HEADER):
+    return None
+  # Info string is on the first line after header
+  line_end = data.find(b"\n", len(STATUS_RESPONSE_HEADER) + 1)
+  if line_end < 0:
+    line_end = len(data)
+  position = data.find(CHALLENGE_KEY, len(STATUS_RESPONSE_HEADER), line_end)
+  if position < 0:
+    return None
+  start = position + len(CHALLENGE_KEY)
+  end = data.find(b"\\", start, line_end)
+  return data[start:end if end >= 0 else line_end]
+
+class ServerStatus():
+  """ Latest status received from a server. """
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    """ Called when server process is started. """
+    self.response : StatusResponse|None = None
+    self.response_time : float|None = None
+    self.map_name : str|None = None
+    self.map_change_time : float|None = None
+
+  def update(self, response:StatusResponse):
+    self.response = response
+    self.response_time = time.monotonic()
+    map_name = response.cvars.get("mapname")
+    if map_name != self.map_name:
+      self.map_name = map_name
+      self.map_change_time = self.response_time
+
+def get_percentile(sorted_values:list[float], fraction:float) -> float:
+  # Nearest-rank percentile
+  return sorted_values[max(0, min(len(sorted_values) - 1, int(len(sorted_values) * fraction + 0.5) - 1))]
+
+class RttTracker():
+  """ Records round trip times of status queries over rolling windows. A hitch is a reply
+  that took longer than the baseline (median over the baseline window) by more than the
+  hitch threshold. """
+  # Window name => length in seconds
+  windows = {"1m": 60, "5m": 300, "1h": 3600}
+  # Histogram bucket upper bounds in seconds
+  buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+  baseline_window = 300
+  # Limit on queries awaiting reply, to discard queries that are never answered
+  max_pending = 32
+
+  def __init__(self, hitch_threshold:float):
+    self.hitch_threshold = hitch_threshold
+    # (receive time, rtt) for samples within the longest window
+    self.samples : collections.deque[tuple[float, float]] = collections.deque()
+    # sequence number => send time
+    self.pending : dict[int, float] = {}
+    self.next_sequence = 0
+    # Cumulative histogram since manager start
+    self.bucket_counts = [0] * len(self.buckets)
+    self.count = 0
+    self.sum = 0.0
+    self.hitch_count = 0
+    self.last_hitch : tuple[float, float, float]|None = None   # (wall time, rtt, baseline)
+
+  def query_sent(self) -> int:
+    """ Returns sequence number to include in query. """
+    sequence = self.next_sequence
+    self.next_sequence += 1
+    self.pending[sequence] = time.perf_counter()
+    if len(self.pending) > self.max_pending:
+      self.pending.pop(next(iter(self.pending)))
+    return sequence
+
+  def clear_pending(self):
+    self.pending.clear()
+
+  def get_baseline(self, now:float) -> float|None:
+    values = sorted(rtt for sample_time, rtt in self.samples if sample_time >= now - self.baseline_window)
+    return get_percentile(values, 0.5) if values else None
+
+  def reply_received(self, sequence:int) -> tuple[float, float]|None:
+    """ Records reply for query sequence number. Returns (rtt, baseline) if reply is a hitch. """
+    if (send_time := self.pending.pop(sequence, None)) == None:
+      return None
+    now = time.perf_counter()
+    rtt = now - send_time
+    baseline = self.get_baseline(now)
+
+    self.samples.append((now, rtt))
+    while self.samples[0][0] < now - max(self.windows.values()):
+      self.samples.popleft()
+    self.count += 1
+    self.sum += rtt
+    for index, bound in enumerate(self.buckets):
+      if rtt <= bound:
+        self.bucket_counts[index] += 1
+
+    if baseline != None and rtt - baseline > self.hitch_threshold:
+      self.hitch_count += 1
+      self.last_hitch = (time.time(), rtt, baseline)
+      return rtt, baseline
+    return None
+
+  def get_window_stats(self) -> dict[str, dict]:
+    """ Returns count, p50, p99 and max in milliseconds for each window with samples. """
+    now = time.perf_counter()
+    result = {}
+    for name, length in self.windows.items():
+      values = sorted(rtt for sample_time, rtt in self.samples if sample_time >= now - length)
+      if values:
+        result[name] = {
+          "count": len(values),
+          "p50": round(get_percentile(values, 0.5) * 1000, 2),
+          "p99": round(get_percentile(values, 0.99) * 1000, 2),
+          "max": round(values[-1] * 1000, 2),
+        }
+    return result
+
+  def get_summary(self, window:str) -> str|None:
+    if stats := self.get_window_stats().get(window):
+      return f"status rtt ({window}): p50 {stats['p50']}ms, p99 {stats['p99']}ms, max {stats['max']}ms, " \
+             f"{stats['count']} samples, {self.hitch_count} hitches total"
+    return None
+
+  def export_serializable(self) -> dict:
+    return {
+      "rtt_ms": self.get_window_stats(),
+      "hitch_count": self.hitch_count,
+      "last_hitch": None if not self.last_hitch else {
+        "time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.last_hitch[0])),
+        "rtt_ms": round(self.last_hitch[1] * 1000, 2),
+        "baseline_ms": round(self.last_hitch[2] * 1000, 2),
+      },
+    }
+
+def escape_label(value:str) -> str:
+  return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class MetricsWriter():
+  """ Builds text in Prometheus exposition format. Samples are grouped by metric name,
+  since each metric must be written as a single group. """
+  def __init__(self):
+    # name => (type, help, sample lines)
+    self.metrics : dict[str, tuple[str, str, list[str]]] = {}
+
+  def add(self, name:str, metric_type:str, help:str, labels:dict[str, str], value:float, suffix:str=""):
+    """ Adds sample. Suffix is appended to name for histogram components, e.g. "_bucket". """
+    label_str = ",".join(f'{key}="{escape_label(str(label))}"' for key, label in labels.items())
+    # Written at full precision, since byte counts and totals can exceed 6 significant digits
+    value_str = repr(value) if isinstance(value, float) else str(int(value))
+    self.metrics.setdefault(name, (metric_type, help, []))[2].append(f"{name}{suffix}{{{label_str}}} {value_str}")
+
+  def get_text(self) -> str:
+    lines : list[str] = []
+    for name, (metric_type, help, samples) in self.metrics.items():
+      lines.append(f"# HELP {name} {help}")
+      lines.append(f"# TYPE {name} {metric_type}")
+      lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+def write_status_metrics(writer:MetricsWriter, server_name:str, status:ServerStatus, up:bool):
+  labels = {"server": server_name}
+  writer.add("efserver_up", "gauge", "Whether server responded to the most recent status queries.", labels, int(up))
+  if not status.response or status.response_time == None:
+    return
+  now = time.monotonic()
+  players = status.response.players
+  bots = [player for player in players if player.is_bot()]
+  humans = [player for player in players if not player.is_bot()]
+  writer.add("efserver_status_age_seconds", "gauge", "Time since last status response.", labels,
+             round(now - status.response_time, 3))
+  writer.add("efserver_players", "gauge", "Number of human players.", labels, len(humans))
+  writer.add("efserver_bots", "gauge", "Number of bots.", labels, len(bots))
+  try:
+    max_clients = int(status.response.cvars.get("sv_maxclients", ""))
+    writer.add("efserver_max_clients", "gauge", "Value of sv_maxclients.", labels, max_clients)
+  except ValueError:
+    pass
+  if status.map_name != None and status.map_change_time != None:
+    writer.add("efserver_map_info", "gauge", "Current map.", {**labels, "map": status.map_name}, 1)
+    writer.add("efserver_map_age_seconds", "gauge", "Time since map change was observed.", labels,
+               round(now - status.map_change_time, 3))
+  for index, player in enumerate(humans):
+    writer.add("efserver_player_ping_ms", "gauge", "Ping of each human player, by position in status response.",
+               {**labels, "player": str(index)}, player.ping)
+
+def write_rtt_metrics(writer:MetricsWriter, server_name:str, rtt:RttTracker):
+  labels = {"server": server_name}
+  name = "efserver_status_rtt_seconds"
+  help = "Round trip time of status queries."
+  for bound, count in zip(rtt.buckets, rtt.bucket_counts):
+    writer.add(name, "histogram", help, {**labels, "le": f"{bound:g}"}, count, "_bucket")
+  writer.add(name, "histogram", help, {**labels, "le": "+Inf"}, rtt.count, "_bucket")
+  writer.add(name, "histogram", help, labels, round(rtt.sum, 6), "_sum")
+  writer.add(name, "histogram", help, labels, rtt.count, "_count")
+  for window, stats in rtt.get_window_stats().items():
+    for stat in ("p50", "p99", "max"):
+      writer.add("efserver_status_rtt_window_ms", "gauge", "Status round trip time statistics over rolling windows.",
+                 {**labels, "window": window, "stat": stat}, stats[stat])
+  writer.add("efserver_status_hitches_total", "counter", "Status replies exceeding baseline by hitch threshold.",
+             labels, rtt.hitch_count)
@@ -0,0 +1,76 @@
+"""
+Limits how many servers are in their startup phase at once, so servers starting together
+(such as after a reboot) don't all load resources at the same time. Waiting servers are
+admitted in priority order.
+"""
+
+import asyncio
+import heapq
+import time
+import typing
+
+class StartupScheduler():
+  """ Admits at most limit servers at once, or any number if limit is 0. Higher priority
+  servers are admitted first, with ties admitted in name order. Slots are held by owner
+  object rather than name, so a replaced server can't release its replacement's slot. """
+  def __init__(self, limit:int, log_batch:typing.Callable[[str], None]):
+    self.limit = limit
+    self.log_batch = log_batch
+    self.active : set[object] = set()
+    # (-priority, name, sequence, owner, future)
+    self.waiting : list[tuple[int, str, int, object, asyncio.Future]] = []
+    self.sequence = 0
+    self.dispatch_pending = False
+    # Stats for current batch of startups, from when scheduler was last idle
+    self.batch_start : float|None = None
+    self.batch_durations : list[float] = []
+
+  def get_waiting_count(self) -> int:
+    return sum(1 for entry in self.waiting if not entry[4].done())
+
+  async def acquire(self, owner:object, name:str, priority:int):
+    if self.batch_start == None:
+      self.batch_start = time.monotonic()
+    future = asyncio.get_running_loop().create_future()
+    heapq.heappush(self.waiting, (-priority, name, self.sequence, owner, future))
+    self.sequence += 1
+    # Dispatch on next loop iteration, so servers requesting a slot at the same time
+    # are admitted by priority rather than by which task ran first
+    if not self.dispatch_pending:
+      self.dispatch_pending = True
+      asyncio.get_running_loop().call_soon(self.dispatch)
+    try:
+      await future
+    except asyncio.CancelledError:
+      # Release if cancelled after being admitted
+      if future.done() and not future.cancelled():
+        self.release(owner)
+      raise
+
+  def dispatch(self):
+    self.dispatch_pending = False
+    while self.waiting and (self.limit <= 0 or len(self.active) < self.limit):
+      _, _, _, owner, future = heapq.heappop(self.waiting)
+      if future.done():
+        # Waiting task was cancelled
+        continue
+      self.active.add(owner)
+      future.set_result(None)
+
+  def release(self, owner:object, duration:float|None=None):
+    """ Ends startup phase for owner. Duration is the measured startup time if startup
+    completed successfully. Safe to call more than once. """
+    if not owner in self.active:
+      return
+    self.active.remove(owner)
+    if duration != None:
+      self.batch_durations.append(duration)
+    self.dispatch()
+    if not self.active and not self.get_waiting_count() and self.batch_start != None:
+      if self.batch_durations:
+        durations = self.batch_durations
+        self.log_batch(f"Startup batch completed: {len(durations)} servers started in "
+                       f"{time.monotonic() - self.batch_start:.1f}s with limit {self.limit or 'unlimited'} "
+                       f"(mean {sum(durations) / len(durations):.1f}s, max {max(durations):.1f}s per server)")
+      self.batch_start = None
+      self.batch_durations = []
@@ -283,11 +283,13 @@ function module.init_server(config)
       end
       com.cmd_exec("bot_reskill_all", "now")
 
-      -- configure entity conversion
-      if vote_state.map_info.entity_type_painkeep then
-        config_utils.set_cvar("lua_entityConvertType", "painkeep")
-      elseif vote_state.map_info.entity_type_quake3 then
-        config_utils.set_cvar("lua_entityConvertType", "quake3")
+      -- configure entity conversion (skipped if already converted by resource loader)
+      if not vote_state.map_info.entities_preconverted then
+        if vote_state.map_info.entity_type_painkeep then
+          config_utils.set_cvar("lua_entityConvertType", "painkeep")
+        elseif vote_state.map_info.entity_type_quake3 then
+          config_utils.set_cvar("lua_entityConvertType", "quake3")
+        end
       end
 
       -- configure pak references
@@ -5,6 +5,10 @@ Implements support for loading maps from either a standard bsp or a map info fil
 maploader.load_map_info and maploader.get_available_maps can be used to query for available
 maps, while maploader.launch_map is used to launch a map.
 
+If the resource loader map index is available, map queries are served from the index rather
+than individual map info files. The index is cached until the next map start, or until
+maploader.refresh_maps or maploader.reset_map_index is called.
+
 Variables:
 maploader.map_info: Map info of currenly loading/running map, set by maploader.launch_map
 maploader.config.mapsource_db: Whether to search for maps in json index
@@ -31,13 +35,69 @@ local function print_msg(...)
   logging.printf("MAPLOADER", "Map Loader: %s", string.format(...))
 end
 
+---------------------------------------------------------------------------------------
+-- Returns cached map index, or nil if not available.
+local function get_map_index()
+  if ls.map_index == nil then
+    ls.map_index = false
+    local success, error_info = pcall(function()
+      local data, file_exists = com.read_file("mapdb_index/index.json")
+      if file_exists then
+        local index = json.decode(data)
+        assert(type(index) == "table" and type(index.maps) == "table")
+        local records, records_exist = com.read_file(index.records_file)
+        assert(records_exist, "missing records file")
+        ls.map_index = { maps = index.maps, records = records }
+      end
+    end)
+
+    if not success then
+      logging.printf("MAPLOADER WARNINGS", "WARNING: get_map_index encountered error '%s' loading map index",
+        tostring(error_info))
+    end
+  end
+
+  return ls.map_index or nil
+end
+
+---------------------------------------------------------------------------------------
+-- Clears cached map index, so it will be reloaded on the next map query.
+function maploader.reset_map_index()
+  ls.map_index = nil
+end
+
+---------------------------------------------------------------------------------------
+-- Refreshes filesystem to pick up newly added or updated maps, and clears cached map index.
+function maploader.refresh_maps()
+  com.fs_auto_refresh()
+  maploader.reset_map_index()
+end
+
+---------------------------------------------------------------------------------------
+-- Returns map info from map index, or nil if not found.
+local function load_indexed_map_info(index, map_name)
+  local entry = index.maps[map_name] or index.maps[map_name:lower()]
+  if entry then
+    local result = json.decode(index.records:sub(entry.offset + 1, entry.offset + entry.length))
+    assert(type(result) == "table")
+    return result
+  end
+  return nil
+end
+
 ---------------------------------------------------------------------------------------
 -- Load map info if map was located. Returns nil on error or map not found.
--- Call com.fs_auto_refresh() ahead of this function if necessary to find newly added maps.
+-- Call maploader.refresh_maps() ahead of this function if necessary to find newly added maps.
 function maploader.load_map_info(map_name, verbose)
   if maploader.config.mapsource_db then
     local result = nil
     local success, error_info = pcall(function()
+      local index = get_map_index()
+      if index then
+        result = load_indexed_map_info(index, map_name)
+        return
+      end
+
       local data, file_exists = com.read_file(string.format("mapdb_info/%s.json", map_name))
       if file_exists then
         result = json.decode(data)
@@ -80,9 +140,16 @@ function maploader.get_available_maps()
   local output = {}
 
   if maploader.config.mapsource_db then
-    for _, path in ipairs(com.list_files("mapdb_info/", ".json")) do
-      local name = path:sub(1, path:len() - 5)
-      output[name] = true
+    local index = get_map_index()
+    if index then
+      for name, _ in pairs(index.maps) do
+        output[name] = true
+      end
+    else
+      for _, path in ipairs(com.list_files("mapdb_info/", ".json")) do
+        local name = path:sub(1, path:len() - 5)
+        output[name] = true
+      end
     end
   end
 
@@ -130,6 +197,13 @@ utils.register_event_handler(sv.events.get_resource_path, function(context, ev)
   end
 end, "maploader")
 
+---------------------------------------------------------------------------------------
+-- Filesystem may have been refreshed during map load, so reload index on next query.
+utils.register_event_handler(sv.events.post_map_start, function(context, ev)
+  maploader.reset_map_index()
+  context:call_next(ev)
+end, "maploader")
+
 ---------------------------------------------------------------------------------------
 utils.register_event_handler(sv.events.load_entities, function(context, ev)
   if maploader.map_info and maploader.map_info.ent_file then
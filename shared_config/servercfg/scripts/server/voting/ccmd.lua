@@ -8,6 +8,7 @@ the "map" command can also be overridden to process map commands like a vote.
 
 local utils = require("scripts/core/utils")
 local voting_utils = require("scripts/server/voting/utils")
+local maploader = require("scripts/server/maploader")
 
 local ccmd = core.init_module()
 
@@ -69,7 +70,7 @@ for _, cmd in ipairs({ "map", "devmap", "spmap" }) do
     context.ignore_uncalled = true
 
     -- check if maps were just added
-    com.fs_auto_refresh()
+    maploader.refresh_maps()
 
     run_command(voting_utils.get_arguments(0))
   end, "voting_ccmd", 10)